@@ -0,0 +1,242 @@
+#!/usr/bin/env python2
+
+"""Benchmark treecall sub-commands and their inner kernels on synthetic data
+
+A random lineage tree is simulated for the samples (coalescent topology and branch lengths) and
+each site gets one heterozygous mutation on a branch chosen in proportion to its length (a fraction
+of the sites are instead germline heterozygous in every sample), as in the ms + dwgsim simulations
+of sims_for_paper. Reads are drawn at Poisson depth with sequencing errors and turned into the
+PL/AD fields of an mpileup-style vcf.
+
+Every case runs in a fresh process, so its peak RSS is its own. Sub-commands are timed from process
+start to exit (including the vcf parsing); kernels are timed around the call only, after their
+inputs are set up.
+"""
+
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+import shutil
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+COMMANDS = ('compat', 'nbjoin', 'gtype', 'annot', 'compare', 'pipeline')
+KERNELS = ('make_D', 'neighbor_joining', 'populate_tree_PL', 'calc_mut_likelihoods', 'calc_compat')
+BASES = 'ACGT'
+GTYPE6 = ((0,0),(0,1),(1,1),(0,2),(1,2),(2,2))  # RR,RA,AA,R*,A*,** of an "X,<*>" record
+
+def simulate_tree(n_smpl, rng):
+    """random coalescent tree of samples 0..n_smpl-1
+
+    Returns:
+        str: the tree in Newick format, leaves named by sample index
+        list: (samples below the branch, branch length) for every branch but the root
+    """
+    nodes = [('%d' % i, [i], 0.0) for i in xrange(n_smpl)]  # newick, samples, height
+    branches = []
+    height = 0.0
+    while len(nodes) > 1:
+        k = len(nodes)
+        height += rng.exponential(2.0/(k*(k-1)))
+        i,j = sorted(rng.choice(k, 2, replace=False))
+        b,a = nodes.pop(j),nodes.pop(i)
+        for nwk,smpl,h in (a,b):
+            branches.append((smpl, height-h))
+        nodes.append(('(%s,%s)' % (a[0],b[0]), a[1]+b[1], height))
+    return nodes[0][0]+';', branches
+
+def simulate_reads(genotypes, depth, error, rng):
+    """ref/alt read counts for each sample given its genotype (0: ref/ref, 1: ref/alt)"""
+    dp = rng.poisson(depth, size=len(genotypes))
+    p_alt = np.where(genotypes==1, 0.5*(1-error)+0.5*error/3, error/3)
+    alt = rng.binomial(dp, p_alt)
+    return dp-alt, alt
+
+def read_PLs(ref, alt, error):
+    """Phred-scaled likelihoods of the 6 genotypes of alleles ref, alt and <*> (capped at 255)"""
+    q = np.array(((1-error, error/3, error/3), (error/3, 1-error, error/3)))  # P(read base | allele)
+    ll = np.array([ref*np.log10((q[0,x]+q[0,y])/2) + alt*np.log10((q[1,x]+q[1,y])/2) for x,y in GTYPE6]).T
+    return np.minimum(np.rint(-10*(ll - ll.max(axis=1)[:,None])), 255).astype(int)
+
+def simulate_vcf(filename, branches, n_smpl, n_site, depth, error, germline, rng):
+    """write a vcf of n_site sites with one mutation each on a branch drawn in proportion to its length"""
+    lengths = np.array([l for s,l in branches])
+    picks = rng.choice(len(branches), n_site, p=lengths/lengths.sum())
+    with open(filename, 'w') as f:
+        f.write('##fileformat=VCFv4.2\n')
+        f.write('##contig=<ID=sim,length=%d>\n' % (100*n_site+1))
+        f.write('##FORMAT=<ID=PL,Number=.,Type=Integer,Description="List of Phred-scaled genotype likelihoods">\n')
+        f.write('##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths">\n')
+        f.write('\t'.join(['#CHROM','POS','ID','REF','ALT','QUAL','FILTER','INFO','FORMAT'] +
+                          ['s%d' % (i+1) for i in xrange(n_smpl)]) + '\n')
+        for k in xrange(n_site):
+            genotypes = np.zeros(n_smpl, dtype=int)
+            if rng.random_sample() < germline:
+                genotypes[:] = 1
+            else:
+                genotypes[branches[picks[k]][0]] = 1
+            ref,alt = simulate_reads(genotypes, depth, error, rng)
+            PLs = read_PLs(ref, alt, error)
+            r = rng.randint(4)
+            a = (r + 1 + rng.randint(3)) % 4
+            calls = ['%s:%d,%d,0' % (','.join(map(str, pl)), x, y) for pl,x,y in zip(PLs, ref, alt)]
+            f.write('\t'.join(['sim', str(100*k+1), '.', BASES[r], BASES[a]+',<*>', '.', '.', '.', 'PL:AD'] + calls) + '\n')
+
+def simulate(data, args):
+    """write the true tree (data/true.nwk) and the reads (data/sim.vcf)"""
+    rng = np.random.RandomState(args.seed)
+    nwk,branches = simulate_tree(args.samples, rng)
+    with open(os.path.join(data, 'true.nwk'), 'w') as f:
+        f.write(nwk + '\n')
+    simulate_vcf(os.path.join(data, 'sim.vcf'), branches, args.samples, args.sites,
+                 args.depth, args.error, args.germline, rng)
+
+def command_args(name, data, args):
+    """treecall.py command line of a sub-command case, run in data/"""
+    cmd = {
+        'compat':  ['compat', 'sim.vcf', 'compat', '-v', str(args.min_ev)],
+        'nbjoin':  ['nbjoin', 'sim.vcf', 'nbjoin', '-m', str(args.mu), '-e', str(args.het), '-v', str(args.min_ev)],
+        'gtype':   ['gtype', 'sim.vcf', 'gtype.txt', '-t', 'true.nwk', '-m', str(args.mu), '-e', str(args.het)],
+        'annot':   ['annot', 'gtype.txt', 'annot.nwk', '-t', 'true.nwk'],
+        'compare': ['compare', '-t', 'nbjoin.best.tre', '-r', 'true.nwk'],
+        'pipeline': ['pipeline', 'sim.vcf', 'pipeline', '-m', str(args.mu), '-e', str(args.het), '-v', str(args.min_ev)],
+    }[name]
+    if name in ('nbjoin', 'pipeline') and args.max_evals is not None:
+        cmd += ['--max-evals', str(args.max_evals)]
+    return [sys.executable, os.path.join(REPO, 'treecall.py')] + cmd
+
+def kernel_args(name, data, args):
+    """command line of this script timing one kernel (see run_kernel)"""
+    return [sys.executable, os.path.abspath(__file__), '--kernel', name,
+            '-m', str(args.mu), '-v', str(args.min_ev), data]
+
+def run_case(name, cmd, data):
+    """run a case in its own process
+
+    Returns:
+        dict: seconds (the kernel's own timing, or the process wall time) and max_rss_kb of the process
+    """
+    log = open(os.path.join(data, name+'.log'), 'w')
+    t0 = time.time()
+    p = subprocess.Popen(cmd, cwd=data, stdout=log, stderr=subprocess.STDOUT)
+    pid,status,rusage = os.wait4(p.pid, 0)
+    seconds = time.time() - t0
+    p.returncode = status
+    log.close()
+    if status != 0:
+        raise RuntimeError('%s failed, see %s' % (name, log.name))
+    if name in KERNELS:
+        with open(log.name) as f:
+            seconds = float(f.read().split()[-1])
+    return {'seconds': round(seconds, 4), 'max_rss_kb': rusage.ru_maxrss}
+
+def run_kernel(name, data, args):
+    """time one kernel on the simulated data, print the seconds as the last line of stdout"""
+    from utils import read_vcf, init_tree, make_mut_matrix_gtype3, populate_tree_PL, calc_mut_likelihoods, lazy_tree
+    from tree_est import make_D, neighbor_joining, init_star_tree
+    from treecall import calc_compat
+    vcffile, variants, DPRs, PLs = read_vcf(os.path.join(data, 'sim.vcf'), args.min_ev)
+    if name != 'calc_compat':
+        PLs = PLs.astype(np.longdouble)  # as nbjoin uses them
+    n_site,n_smpl,n_gtype = PLs.shape
+    mm,mm0,mm1 = make_mut_matrix_gtype3(args.mu)
+    if name in ('populate_tree_PL', 'calc_mut_likelihoods'):
+        tree = init_tree(lazy_tree()(os.path.join(data, 'true.nwk')))
+    if name == 'calc_mut_likelihoods':
+        populate_tree_PL(tree, PLs, mm0, 'PL0')
+    if name == 'neighbor_joining':
+        D = make_D(PLs)
+
+    t0 = time.time()
+    if name == 'make_D':
+        make_D(PLs)
+    elif name == 'neighbor_joining':
+        neighbor_joining(D.copy(), init_star_tree(n_smpl), np.arange(n_smpl))
+    elif name == 'populate_tree_PL':
+        populate_tree_PL(tree, PLs, mm0, 'PL0')
+    elif name == 'calc_mut_likelihoods':
+        calc_mut_likelihoods(tree, mm0, mm1)
+    elif name == 'calc_compat':
+        calc_compat(PLs)
+    print(time.time() - t0)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO, stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(args):
+    data = args.keep or tempfile.mkdtemp(prefix='treecall_bench.')
+    if not os.path.exists(data):
+        os.makedirs(data)
+    data = os.path.abspath(data)
+    cases = args.cases.split(',') if args.cases else list(COMMANDS + KERNELS)
+    for name in cases:
+        if name not in COMMANDS + KERNELS:
+            sys.exit('unknown case %s, choose from %s' % (name, ','.join(COMMANDS + KERNELS)))
+    if 'compare' in cases and 'nbjoin' not in cases:
+        sys.exit('compare needs the tree from nbjoin')
+    if 'annot' in cases and 'gtype' not in cases:
+        sys.exit('annot needs the calls from gtype')
+
+    try:
+        print('simulating %d samples x %d sites in %s' % (args.samples, args.sites, data), file=sys.stderr)
+        simulate(data, args)
+        results = {}
+        for name in [c for c in COMMANDS + KERNELS if c in cases]:
+            times,rss = [],[]
+            for r in xrange(args.repeat):
+                cmd = command_args(name, data, args) if name in COMMANDS else kernel_args(name, data, args)
+                res = run_case(name, cmd, data)
+                times.append(res['seconds'])
+                rss.append(res['max_rss_kb'])
+            results[name] = {'seconds': min(times), 'max_rss_kb': max(rss)}
+            print('%-22s %10.3f s %10d KB' % (name, min(times), max(rss)), file=sys.stderr)
+    finally:
+        if args.keep is None:
+            shutil.rmtree(data)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'params': dict((k,getattr(args,k)) for k in ('samples','sites','depth','error','germline','mu','het','min_ev','max_evals','seed','repeat')),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark treecall sub-commands and kernels on simulated data')
+    parser.add_argument('output', metavar='<output>', type=str, help='json report (runtime and peak RSS of each case); in --kernel mode, the simulated data directory')
+    parser.add_argument('-n', metavar='INT', dest='samples', type=int, default=10, help='number of samples, default 10')
+    parser.add_argument('-s', metavar='INT', dest='sites', type=int, default=1000, help='number of sites, default 1000')
+    parser.add_argument('-d', metavar='FLOAT', dest='depth', type=float, default=10, help='mean read depth per sample, default 10')
+    parser.add_argument('-r', metavar='FLOAT', dest='error', type=float, default=0.01, help='sequencing error rate, default 0.01')
+    parser.add_argument('-g', metavar='FLOAT', dest='germline', type=float, default=0.0, help='fraction of sites heterozygous in every sample, default 0')
+    parser.add_argument('-m', metavar='INT', dest='mu', type=int, default=80, help='mutation rate in Phred scale passed to nbjoin/gtype, default 80')
+    parser.add_argument('-e', metavar='INT', dest='het', type=int, default=30, help='heterozygous rate in Phred scale passed to nbjoin/gtype, default 30')
+    parser.add_argument('-v', metavar='INT', dest='min_ev', type=int, default=60, help='minimum evidence in Phred scale for a site to be considered, default 60')
+    parser.add_argument('--max-evals', metavar='INT', dest='max_evals', type=int, help='nbjoin --max-evals, to bound the tree search on large data')
+    parser.add_argument('--seed', metavar='INT', dest='seed', type=int, default=1, help='random seed of the simulation, default 1')
+    parser.add_argument('--repeat', metavar='INT', dest='repeat', type=int, default=1, help='run each case INT times, report the fastest time and largest RSS, default 1')
+    parser.add_argument('--cases', metavar='STR', dest='cases', type=str, help='comma separated cases to run, default all: ' + ','.join(COMMANDS + KERNELS))
+    parser.add_argument('--keep', metavar='DIR', dest='keep', type=str, help='simulate and run in DIR and keep it, default a temporary directory')
+    parser.add_argument('--kernel', metavar='STR', dest='kernel', choices=KERNELS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.kernel:
+        run_kernel(args.kernel, args.output, args)
+    else:
+        main(args)
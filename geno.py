@@ -11,85 +11,136 @@ signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 import sys
 import numpy as np
-import vcf
-
-with warnings.catch_warnings(ImportWarning):
-    from ete2 import Tree
 
 warnings.filterwarnings('error')
 
 from utils import *
 
-def read_vcf_records(filename, maxn=1000):
+GTCALL_DTYPE = [('chrom','a10'),('pos','i4'),('ref','a1'),
+                ('null_p','f8'),('mut_p','f8'),
+                ('null_base','a2'),('null_base_p','f8'),
+                ('mut_base','a2'),('mut_alt','a2'),('mut_conf_p','f8'),
+                ('mut_loc','i4'),('mut_smpl','a128')] # fields of a gtype call
+
+GTYPE10 = np.array(('AA','AC','AG','AT','CC','CG','CT','GG','GT','TT')) # the 10 genotypes of A/C/G/T in alphabetical order, as in gtype10_PLs
+
+def read_vcf_records(filename):
     """Read vcf file - get info about variants - need to clarify how this is different from read_vcf
 
     Args:
         filename: name of vcf file to read
-        maxn (int): number of lines / sites in file to process
 
     Returns:
-        np.array (tuple): variant info (chrom, pos, ref)
+        np.array (tuple): variant info (chrom, pos, ref, alt), alt lists the A/C/G/T alleles separated by ","
         np.array (int): Number of high-quality bases observed for each of the alleles
         np.array (double): List of Phred-scaled genotype likelihoods for all 10 possible genotypes
 
+    Raises:
+        ValueError: no A/C/G/T SNP sites in the vcf
+
     """    
-    print('read sites', end = ' ', file=sys.stderr)
-    
-    vcffile = vcf.Reader(open(filename, 'r'))
-    variants,ADs,PLs = [],[],[]
+    for block in iter_vcf_records(filename, None):
+        return block[:3]
+    raise ValueError('%s: no A/C/G/T SNP sites' % filename)
+
+def iter_vcf_records(filename, maxn=1000):
+    """read_vcf_records() a block of sites at a time
+
+    Args:
+        filename: name of vcf file to read, or an open vcf.Reader
+        maxn (int): number of lines / sites in each block, None for all in one block
+
+    Yields:
+        variants, ADs, PLs of each block, as returned by read_vcf_records()
+        list: the vcf records of these sites
+
+    """    
+    vcf = lazy_import('vcf')
+    vcffile = filename if isinstance(filename, vcf.Reader) else vcf.Reader(open(filename, 'r'))
+    variants,ADs,PLs,records = [],[],[],[]
     bases = ['A','C','G','T']
-    i = 0
+    PROGRESS.start('read_vcf_records', 'sites')
+    t_block = PROFILE.clock()
     for v in vcffile:
-        i += 1
-        if i%1000 == 0:
-            print(str(i) , end = '.', file=sys.stderr)
+        PROGRESS.update()
         if v.REF in bases and v.ALT[0] in bases:
-            variants.append((v.CHROM,v.POS,v.REF))
+            records.append(v)
             #ad for each sample for each allele
             ad = np.array([v.genotype(s).data.AD for s in vcffile.samples], dtype=np.uint16)                
             ADs.append(ad)
             
-            s = [str(b) for b in v.ALT if str(b) in bases] #filter X
-            s.insert(0,str(v.REF))
-            #this is a silly way to find the correct genotypes in the pls
-            if len(s) == 2:
-                find_geno = {0:s[0]+s[0], 1:''.join(sorted(s[0]+s[1])), 2:s[1]+s[1]}
-            elif len(s) == 3:
-                find_geno = {0:s[0]+s[0], 1:''.join(sorted(s[0]+s[1])), 2:s[1]+s[1], 3:''.join(sorted(s[0]+s[2])), 4:''.join(sorted(s[1]+s[2])), 5:s[2]+s[2]}
-            elif len(s) == 4:
-                find_geno = {0:s[0]+s[0], 1:''.join(sorted(s[0]+s[1])), 2:s[1]+s[1], 3:''.join(sorted(s[0]+s[2])), 4:''.join(sorted(s[1]+s[2])), 5:s[2]+s[2], 6:''.join(sorted(s[0]+s[3])), 7:''.join(sorted(s[1]+s[3])), 8:''.join(sorted(s[2]+s[3])), 9:s[3]+s[3]}
-                             
             #get pl for ref and alts
             pl = [v.genotype(s).data.PL for s in vcffile.samples]  #list of lists
-            for j,p in enumerate(pl):
-                pl_dict = {'AA':255,'AC':255,'AG':255,'AT':255,'CC':255,'CG':255,'CT':255,'GG':255,'GT':255,'TT':255} #all genos are unlikely
-                
-                #triallelic the PL pattern is RR,RA1,A1A1,RA2,A1A2,A2A2
-                for o in range(len(find_geno)):
-                    g = find_geno[o]
-                    pl_dict[g] = p[o]  #pl for that geno
-                assert len(pl_dict) == 10, sorted(pl_dict.keys())
-                    
-                #get PL for all 10 in alpha order as np
-                pl[j] = np.array([float(geno_pl) for geno,geno_pl in sorted(pl_dict.items())], dtype = np.longdouble)  #float, but should be np array longdouble
-
-            pl = np.array(pl)
-            assert pl.shape == (len(vcffile.samples),10), pl.shape
+            alt,pl = gtype10_PLs(v.REF, v.ALT, pl)
+            variants.append((v.CHROM,v.POS,v.REF,alt))
             PLs.append(pl)
+            if len(PLs) == maxn:
+                block = vcf_block(variants, ADs, PLs, vcffile.samples) + (records,)
+                PROFILE.add('read_vcf_records', t_block)  # parsing only, not the caller's work on the block
+                yield block
+                variants,ADs,PLs,records = [],[],[],[]
+                t_block = PROFILE.clock()
+
+    PROGRESS.finish()
+    if PLs:
+        block = vcf_block(variants, ADs, PLs, vcffile.samples) + (records,)
+        PROFILE.add('read_vcf_records', t_block)
+        yield block
+
+def gtype10_PLs(ref, alts, pl):
+    """PLs of a vcf record for all 10 genotypes of A/C/G/T, 255 for the genotypes it does not list
 
+    Args:
+        ref (str): REF of the record
+        alts (list): ALT of the record
+        pl (list): PL of each sample as listed in the record
+
+    Returns:
+        str: the A/C/G/T alleles of alts separated by ","
+        np.array (longdouble): PLs of each sample for the 10 genotypes in alphabetical order, sample x 10
+    """
+    bases = ['A','C','G','T']
+    s = [str(b) for b in alts if str(b) in bases] #filter X
+    alt = ','.join(s)
+    s.insert(0,str(ref))
+    #this is a silly way to find the correct genotypes in the pls
+    if len(s) == 2:
+        find_geno = {0:s[0]+s[0], 1:''.join(sorted(s[0]+s[1])), 2:s[1]+s[1]}
+    elif len(s) == 3:
+        find_geno = {0:s[0]+s[0], 1:''.join(sorted(s[0]+s[1])), 2:s[1]+s[1], 3:''.join(sorted(s[0]+s[2])), 4:''.join(sorted(s[1]+s[2])), 5:s[2]+s[2]}
+    elif len(s) == 4:
+        find_geno = {0:s[0]+s[0], 1:''.join(sorted(s[0]+s[1])), 2:s[1]+s[1], 3:''.join(sorted(s[0]+s[2])), 4:''.join(sorted(s[1]+s[2])), 5:s[2]+s[2], 6:''.join(sorted(s[0]+s[3])), 7:''.join(sorted(s[1]+s[3])), 8:''.join(sorted(s[2]+s[3])), 9:s[3]+s[3]}
+
+    pl = list(pl)
+    for j,p in enumerate(pl):
+        pl_dict = {'AA':255,'AC':255,'AG':255,'AT':255,'CC':255,'CG':255,'CT':255,'GG':255,'GT':255,'TT':255} #all genos are unlikely
+        
+        #triallelic the PL pattern is RR,RA1,A1A1,RA2,A1A2,A2A2
+        for o in range(len(find_geno)):
+            g = find_geno[o]
+            pl_dict[g] = p[o]  #pl for that geno
+        assert len(pl_dict) == 10, sorted(pl_dict.keys())
+            
+        #get PL for all 10 in alpha order as np
+        pl[j] = np.array([float(geno_pl) for geno,geno_pl in sorted(pl_dict.items())], dtype = np.longdouble)  #float, but should be np array longdouble
+
+    pl = np.array(pl)
+    assert pl.shape == (len(pl),10), pl.shape
+    return alt, pl
+
+def vcf_block(variants, ADs, PLs, samples):
+    """convert the lists collected by iter_vcf_records() to arrays"""
     variants = np.array(variants)
     PLs = np.array(PLs)
     num_var, num_samp, num_geno = PLs.shape
-    assert num_samp == len(vcffile.samples)
+    assert num_samp == len(samples)
     assert num_geno == 10
  #   DPRs = np.array(ADs)
-
-    print(' done', file=sys.stderr)
     return variants, ADs, PLs
 
 def genotype_main(args):
     """
-    uses init_tree, make_base_prior, make_mut_matrix, read_vcf_records, genotype
+    uses init_tree, make_base_prior, make_mut_matrix, iter_vcf_records, genotype, write_gtcall, write_gtcall_vcf
     
     Args:
         vcf: input vcf/vcf.gz file, "-" for stdin
@@ -98,12 +149,85 @@ def genotype_main(args):
         nsite: number of sites processed once, default 1000
         mu: mutation rate in Phred scale, default 80
         het: heterozygous rate in Phred scale, default 30, 0 for uninformative
+        output_type: "text" for tab-delimited calls, "vcf" for the genotyped vcf records with the calls in INFO
     """
     
-    GTYPE10 = np.array(('AA','AC','AG','AT','CC','CG','CT','GG','GT','TT'))
+    Tree = lazy_tree()
+    vcf = lazy_import('vcf')
     print(args, file=sys.stderr)
 
-    tree = Tree(args.tree)
+    tree,leaves = gtype_tree(Tree(args.tree))
+
+    base_prior = make_base_prior(args.het, GTYPE10) # base genotype prior
+    mm,mm0,mm1 = make_mut_matrix_gtype10(args.mu)#, GTYPE10) # substitution rate matrix, with non-diagonal set to 0, with diagonal set to 0
+
+    score = 0
+    vcffile = vcf.Reader(open(args.vcf, 'r'))
+    with open(args.output, 'w') as fout:
+        if args.output_type == 'vcf':
+            for key,num,typ,desc in GTCALL_INFO:
+                vcffile.infos[key] = vcf.parser._Info(key, num, typ, desc, None, None)
+            writer = vcf.Writer(fout, vcffile)
+        for variants, DPRs, PLs, vcf_records in iter_vcf_records(vcffile, args.nsite):
+            records,block_score = genotype(PLs, tree, variants, mm, mm0, mm1, base_prior,leaves)
+            # each block is on disk before the next is read
+            if args.output_type == 'vcf':
+                write_gtcall_vcf(writer, vcf_records, records)
+            else:
+                write_gtcall(fout, records)
+            score += block_score
+    print('sum(PL) = %.2f' % score)
+
+GTCALL_FMT = '%s\t%d\t%s\t%.2e\t%.2e\t%s\t%.2e\t%s\t%s\t%.2e\t%d\t%s\n'
+
+@profiled('write_gtcall')
+def write_gtcall(f, records):
+    """write gtype calls as tab-delimited text and flush
+
+    Args:
+        f (file): output
+        records (np.array): GTCALL_DTYPE, fields are: chrom,pos,ref,null_P,mut_P,MLE_null_base_gtype,MLE_null_base_gtype_P,
+            MLE_mut_base_gtype,MLE_mut_alt_gtype,MLE_mut_base_gtype_P,MLE_mut_location,MLE_mut_samples
+    """
+    f.write(''.join([GTCALL_FMT % r for r in records.tolist()]))
+    f.flush()
+
+GTCALL_INFO = [('NULL_P',1,'Float','Probability of no mutation in the lineage tree'),
+               ('MUT_P',1,'Float','Probability of a single mutation in the lineage tree'),
+               ('NULL_BASE',1,'String','Most likely genotype of all samples without mutation'),
+               ('NULL_BASE_P',1,'Float','Probability of NULL_BASE'),
+               ('MUT_BASE',1,'String','Most likely base genotype with a single mutation'),
+               ('MUT_ALT',1,'String','Most likely mutant genotype'),
+               ('MUT_CONF_P',1,'Float','Probability of the most likely mutation'),
+               ('MUT_LOC',1,'Integer','Most likely mutation location, index of the node in postorder'),
+               ('MUT_SMPL',None,'String','Samples under the most likely mutation location')] # INFO of gtype calls, in GTCALL_DTYPE order after ref
+
+@profiled('write_gtcall')
+def write_gtcall_vcf(writer, vcf_records, records):
+    """write gtype calls as INFO of the genotyped vcf records and flush
+
+    Args:
+        writer (vcf.Writer): output, its template has GTCALL_INFO in infos
+        vcf_records (list): the vcf records from iter_vcf_records()
+        records (np.array): GTCALL_DTYPE, calls of vcf_records
+    """
+    for v,r in zip(vcf_records, records.tolist()):
+        for (key,num,typ,desc),value in zip(GTCALL_INFO, r[3:]):
+            if typ == 'Float':
+                value = '%.2e' % value
+            elif num is None:
+                value = value.split(',')
+            v.INFO[key] = value
+        writer.write_record(v)
+    writer.flush()
+
+def gtype_tree(tree):
+    """prepare a lineage tree for genotype(), in place
+
+    Returns:
+        Tree: tree with its leaves renamed 0.. in leaf order, and nid and sid (see init_tree)
+        list: the original leaf names, in leaf order
+    """
     #leaf names need to be from 0 -
     leaves = tree.get_leaf_names()
     for node in tree.traverse(strategy='postorder'):
@@ -112,40 +236,71 @@ def genotype_main(args):
     
     tree = init_tree(tree)  #tree nodes now have nid and sid where nid is node num from 0-
                             #sid is node name if leaf (numbered 0-) or names of children if not
+    return tree,leaves
 
-    base_prior = make_base_prior(args.het, GTYPE10) # base genotype prior
-    mm,mm0,mm1 = make_mut_matrix_gtype10(args.mu)#, GTYPE10) # substitution rate matrix, with non-diagonal set to 0, with diagonal set to 0
+@profiled('genotype')
+def genotype(PLs, tree, variants, mm, mm0, mm1, base_prior,leaves):
+    """
+    uses genotype_groups, call_sites, p2phred
+    """
+    n = PLs.shape[0]
+    node_sids = np.array([','.join(map(str,[leaves[sid] for sid in node.sid])) for node in tree.iter_descendants(strategy='postorder')])
+    records = np.empty(n, dtype=GTCALL_DTYPE)
+    records['chrom'] = variants[:,0]
+    records['pos'] = variants[:,1].astype(np.int32)
+    records['ref'] = variants[:,2]
+    for sites,gt in genotype_groups(variants, GTYPE10):
+        ix = np.ix_(gt,gt)
+        call_sites(records, sites, PLs[sites][...,gt], tree, mm[ix], mm0[ix], mm1[ix], base_prior[gt], GTYPE10[gt], node_sids)
+    score = p2phred(records['mut_p']+records['null_p']).sum()
+    return records,score
 
-    fout = open(args.output, 'w')
-    fout.close()
-    fout = open(args.output, 'a')
-    
-    variants, DPRs, PLs = read_vcf_records(args.vcf)
-    records,score = genotype(PLs, tree, variants, mm, mm0, mm1, base_prior,leaves)
-    #records are: chrom,pos,ref,null_P,mut_P,MLE_null_base_gtype,MLE_null_base_gtype_P,MLE_mut_base_gtype,MLE_mut_base_gtype_P,MLE_mut_location,MLE_mut_samples
-    np.savetxt(fout, records, fmt=['%s','%d','%s','%.2e','%.2e','%s','%.2e','%s','%s','%.2e','%d','%s'], delimiter='\t')
-    print('sum(PL) = %.2f' % score)
-    fout.close()
 
-def genotype(PLs, tree, variants, mm, mm0, mm1, base_prior,leaves):
+def genotype_groups(variants, gtypes):
     """
-    uses populate_tree_PL, calc_mut_likelihoods, phred2p
+    sites sharing the genotypes that can have non-filler PLs: biallelic sites (one alt in variants[:,3])
+    only need the 3 genotypes of their two alleles, other sites need all of gtypes
+
+    Args:
+        variants (np.array): from read_vcf_records
+        gtypes (np.array (str)): genotypes of the PLs, GTYPE10
+
+    Yields:
+        np.array (int): index of the sites
+        np.array (int): index of their genotypes in gtypes
     """
-    GTYPE10 = np.array(('AA','AC','AG','AT','CC','CG','CT','GG','GT','TT'))
-    # calculate total likelihoods for each genotypes
-    tree = populate_tree_PL(tree.copy(), PLs, mm, 'PL') # dim(tree.PL) = site x gtype
-    tree_PL = tree.PL + base_prior
-    # calculate no-mutation likelihoods for each genotypes
-    #try:
-    tree = populate_tree_PL(tree.copy(), PLs, mm0, 'PL0') # dim(tree.PL0) = site x gtype
-    #except Exception as e:
-    #    print('populate_tree_PL():', e, file=sys.stderr)
-    #    sys.exit(1)
-    tree_PL0 = tree.PL0 + base_prior
-    
-    # calculate mutation likelihoods for each genotypes and mutation locations
-    tree = calc_mut_likelihoods(tree.copy(), mm0, mm1)
-    mut_PLs = np.swapaxes(tree.PLm,0,1) # site x location x gtype
+    gtype_idx = {g:i for i,g in enumerate(gtypes)}
+    groups = {}
+    for i,(ref,alt) in enumerate(variants[:,2:4]):
+        if len(alt) == 1:
+            key = tuple(sorted(gtype_idx[''.join(sorted(a+b))] for a,b in ((ref,ref),(ref,alt),(alt,alt))))
+        else:
+            key = tuple(xrange(len(gtypes)))
+        groups.setdefault(key, []).append(i)
+    for key in sorted(groups):
+        yield np.array(groups[key]), np.array(key)
+
+
+def call_sites(records, sites, PLs, tree, mm, mm0, mm1, base_prior, gtypes, node_sids):
+    """
+    fill the calls of some sites into records
+
+    Args:
+        records (np.array): GTCALL_DTYPE
+        sites (np.array (int)): index of the sites in records
+        PLs (np.array): PLs of these sites, dim = site x sample x gtype
+        mm,mm0,mm1: mutation matrices for gtypes
+        base_prior (np.array): base genotype prior for gtypes
+        gtypes (np.array (str)): genotypes of the PLs
+        node_sids (np.array (str)): samples under each mutation location
+
+    uses tree_likelihoods, phred2p
+    """
+    # calculate total likelihoods, no-mutation likelihoods (for each node) and mutation likelihoods for each genotypes
+    tree_PL,node_PL0,tree_PLm = tree_likelihoods(tree, PLs, mm, mm0, mm1)
+    tree_PL = tree_PL + base_prior # dim = site x gtype
+    tree_PL0 = node_PL0[tree] + base_prior # dim = site x gtype
+    mut_PLs = np.swapaxes(tree_PLm,0,1) # site x location x gtype
     mut_PLs += base_prior
     n,l,g = mut_PLs.shape # n sites, l locations, g gtypes
     nn = np.arange(n)
@@ -157,36 +312,21 @@ def genotype(PLs, tree, variants, mm, mm0, mm1, base_prior,leaves):
     null_PL = tree_PL0[nn,k0] # best non-mutation likelihood (across genotypes) for each site
     null_P_per_site = phred2p(tree_PL0).sum(axis=1) # total non-mutation likelihood
 
-    k1 = np.array([np.unravel_index(s.argmin(), (l,g)) for s in mut_PLs]) # site x 2, most likely mutation event for each site
-    k1l = k1[:,0] # most likely location
-    k1g = k1[:,1] # most likely base genotype
+    k1l,k1g = np.divmod(mut_PLs.reshape(n,l*g).argmin(axis=1), g) # most likely mutation event for each site: location, base genotype
     mut_PL = mut_PLs[nn,k1l,k1g] # best mutation likelihood (across location and genotypes) for each site
     mut_P_per_site = phred2p(mut_PLs).sum(axis=(1,2)) # total mutation likelihood
 
-    null_PLs = np.array([node.PL0 for node in tree.iter_descendants(strategy='postorder')])
+    null_PLs = np.array([node_PL0[node] for node in tree.iter_descendants(strategy='postorder')])
     k2 = null_PLs[k1l,nn,].argmin(axis=-1) # get most likely mutation mutant genotype
 
-    node_sids = np.array([','.join(map(str,[leaves[sid] for sid in node.sid])) for node in tree.iter_descendants(strategy='postorder')])
-    records = np.array(zip(
-            variants[nn,0],                         # chrom
-            variants[nn,1],                         # pos
-            variants[nn,2],                         # ref
-            null_P_per_site/tree_P_per_site,        # null_P
-            mut_P_per_site/tree_P_per_site,         # mut_P
-           #GTYPE10[k],                             # MLE_base_gtype
-           #phred2p(tree_PL[nn,k])/tree_P_per_site, # MLE_base_gtype_P
-            GTYPE10[k0],                            # MLE_null_base_gtype
-            phred2p(null_PL)/tree_P_per_site,       # MLE_null_base_gtype_P
-            GTYPE10[k1g],                           # MLE_mut_base_gtype
-            GTYPE10[k2],                            # MLE_mut_alt_gtype
-            phred2p(mut_PL)/tree_P_per_site,        # MLE_mut_base_gtype_P
-            k1l,                                    # MLE_mut_location
-            node_sids[k1l]),                        # MLE_mut_samples
-        dtype=[
-            ('chrom','a10'),('pos','i4'),('ref','a1'),
-            ('null_p','f8'),('mut_p','f8'),
-            ('null_base','a2'),('null_base_p','f8'),
-            ('mut_base','a2'),('mut_alt','a2'),('mut_conf_p','f8'),
-            ('mut_loc','i4'),('mut_smpl','a128')])
-    score = p2phred(records['mut_p']+records['null_p']).sum()
-    return records,score
\ No newline at end of file
+    records['null_p'][sites] = null_P_per_site/tree_P_per_site
+    records['mut_p'][sites] = mut_P_per_site/tree_P_per_site
+   #records['base'][sites] = gtypes[k]                             # MLE_base_gtype
+   #records['base_p'][sites] = phred2p(tree_PL[nn,k])/tree_P_per_site # MLE_base_gtype_P
+    records['null_base'][sites] = gtypes[k0]                      # MLE_null_base_gtype
+    records['null_base_p'][sites] = phred2p(null_PL)/tree_P_per_site # MLE_null_base_gtype_P
+    records['mut_base'][sites] = gtypes[k1g]                      # MLE_mut_base_gtype
+    records['mut_alt'][sites] = gtypes[k2]                        # MLE_mut_alt_gtype
+    records['mut_conf_p'][sites] = phred2p(mut_PL)/tree_P_per_site # MLE_mut_base_gtype_P
+    records['mut_loc'][sites] = k1l                                # MLE_mut_location
+    records['mut_smpl'][sites] = node_sids[k1l]                    # MLE_mut_samples
@@ -0,0 +1,135 @@
+#!/usr/bin/env python2
+
+"""nbjoin -> gtype -> annot in one process
+
+The vcf is parsed once (read_vcf_data) into the PLs used by nbjoin (2 most common alleles) and
+by gtype (all 10 genotypes), the best tree of the search is genotyped as it is, and the calls are
+counted for the annotation as they are made.
+
+    from pipeline import run_pipeline
+    PL, tree, calls = run_pipeline('x.vcf', 'x', max_evals=10000)
+"""
+
+from __future__ import print_function
+import warnings
+import signal
+signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+import sys
+import argparse
+from collections import Counter
+import numpy as np
+
+from utils import PROGRESS, profiled, lazy_import, top2_alleles, init_tree, make_base_prior, make_mut_matrix_gtype10
+from geno import GTYPE10, GTCALL_DTYPE, gtype10_PLs, gtype_tree, genotype, write_gtcall
+
+warnings.filterwarnings('error')
+
+# tree_est and treecall (and with them scipy) are imported by run_pipeline,
+# so that treecall.py pipeline -h starts quickly
+
+@profiled('read_vcf_data')
+def read_vcf_data(filename, evidence=60):
+    """read_vcf() and read_vcf_records() in one pass over a vcf
+
+    Args:
+        filename (str): vcf filename
+        evidence (int): minimum evidence in Phred scale for a site to be considered, as for read_vcf
+
+    Returns:
+        list: sample names
+        np.array (tuple): variant info (chrom, pos, ref, alt) for each variant, as from read_vcf_records
+        np.array (int): allele depth of the 2 most common alleles, as from read_vcf
+        np.array (int): PLs of the 3 genotypes of the 2 most common alleles, as from read_vcf
+        np.array (longdouble): PLs of all 10 genotypes, as from read_vcf_records
+    """
+    vcf = lazy_import('vcf')
+    vcffile = vcf.Reader(open(filename, 'r'))
+    bases = ['A','C','G','T']
+    variants,ADs,PLs,PL10s = [],[],[],[]
+
+    PROGRESS.start('read_vcf_data', 'sites')
+    for v in vcffile:
+        PROGRESS.update()
+        if v.REF in bases and v.ALT[0] in bases:  #check snp
+            data = [v.genotype(s).data for s in vcffile.samples]
+            ad,pl = top2_alleles(np.array([d.AD for d in data], dtype=np.uint16), np.array([d.PL for d in data], dtype=np.uint16))
+            alt,pl10 = gtype10_PLs(v.REF, v.ALT, [d.PL for d in data])
+            variants.append((v.CHROM,v.POS,v.REF,alt))
+            ADs.append(ad)
+            PLs.append(pl)
+            PL10s.append(pl10)
+    PROGRESS.finish()
+
+    return vcffile.samples, np.array(variants), np.array(ADs), np.array(PLs), np.array(PL10s)
+
+def run_pipeline(filename, output, mu=80, het=30, min_ev=60, nsite=1000, **search):
+    """nbjoin, gtype with the best tree and annot of that tree, in one process
+
+    Args:
+        filename (str): input vcf file
+        output (str): output basename
+        mu (int): mutation rate in Phred scale, default 80
+        het (int): heterozygous rate in Phred scale, default 30
+        min_ev (int): minimum evidence in Phred scale for a site to be considered, default 60
+        nsite (int): number of sites genotyped at once, default 1000
+        search: other nbjoin options (processes, split, dist, save_dist, nj_bounded, time_budget, max_evals)
+
+    Output to files:
+        the nbjoin trees and scores (output.N.tre, output.best.tre, output.bestnames.tre, output.scores.txt)
+        output.gtcall.txt: the gtype calls with the best tree
+        output.annot.tre: the best tree annotated with the calls
+
+    Returns:
+        float: score of the best tree, None if the search ended before any tree (nothing else is done)
+        Tree: the annotated best tree, leaves named by sample number
+        np.array: the gtype calls (GTCALL_DTYPE)
+    """
+    neighbor_search = lazy_import('tree_est').neighbor_search
+    annotate_tree = lazy_import('treecall').annotate_tree
+    samples, variants, ADs, PLs, PL10s = read_vcf_data(filename, min_ev)
+
+    opts = dict(output=output, mu=mu, het=het, min_ev=min_ev, processes=1, split='random',
+                dist=None, save_dist=None, nj_bounded=False, time_budget=None, max_evals=None)
+    opts.update(search)
+    best = neighbor_search(PLs, samples, argparse.Namespace(**opts))
+    if best is None:
+        return None, None, None
+    best_PL,tree = best
+    for node in tree.traverse():
+        for f in ('PL0','PLm'):  # likelihoods of the search, not needed any more
+            if hasattr(node, f):
+                delattr(node, f)
+
+    tree,leaves = gtype_tree(tree)
+    base_prior = make_base_prior(het, GTYPE10) # base genotype prior
+    mm,mm0,mm1 = make_mut_matrix_gtype10(mu)
+    calls = []
+    n_mut = Counter()  #number of calls for each set of mutated samples
+    score = 0
+    with open(output+'.gtcall.txt', 'w') as fout:
+        for i in xrange(0, len(variants), nsite):
+            records,block_score = genotype(PL10s[i:(i+nsite)], tree, variants[i:(i+nsite)], mm, mm0, mm1, base_prior, leaves)
+            write_gtcall(fout, records)
+            n_mut.update(records['mut_smpl'].tolist())
+            calls.append(records)
+            score += block_score
+    print('sum(PL) = %.2f' % score)
+
+    for leaf in tree.iter_leaves():
+        leaf.name = leaves[leaf.name]  #back to the sample numbers
+    tree = annotate_tree(init_tree(tree), n_mut)
+    tree.write(outfile=output+'.annot.tre', format=5)
+
+    calls = np.concatenate(calls) if calls else np.zeros(0, dtype=GTCALL_DTYPE)
+    return best_PL, tree, calls
+
+def pipeline_main(args):
+    """run_pipeline() with the options of the pipeline sub-command"""
+    print(args, file=sys.stderr)
+    best_PL,tree,calls = run_pipeline(args.vcf, args.output, mu=args.mu, het=args.het, min_ev=args.min_ev, nsite=args.nsite,
+                                      processes=args.processes, split=args.split, nj_bounded=args.nj_bounded,
+                                      time_budget=args.time_budget, max_evals=args.max_evals)
+    if best_PL is None:
+        print('no tree searched, nothing to genotype', file=sys.stderr)
+        sys.exit(1)
@@ -1,8 +1,9 @@
 import sys
 sys.path.append('../')
+from ete2 import Tree  # before tree_est, which turns warnings into errors
 from tree_est import *
-from ete2 import Tree
 import numpy as np
+import pytest
 
 def test_read_vcf():
     input_vcf = 'test_tree.vcf'
@@ -88,7 +89,7 @@ def test_neighbor_joining():
     exp_D0 = np.array([ 0.0, 33.871108, 14.227027, 13.116167, 9.5826634, 35.841953, 11.934258, 11.326775, 13.333432, 43.27041, 60.619184, 77.172342, 12.930811, 15.712338, -15.291832,  0.0 , 0.0, 0.0])
     assert(np.isclose(D[0], exp_D0).all()==True), 'Error updating difference matrix'
     
-    exp_tree = '((4:-50,(2:-26,(1:-4,(5:5,9:12)1:21)1:103)1:62)1:1,(8:-107,(0:-15,(7:-5,(3:6,6:5)1:14)1:31)1:125)1:1);'
+    exp_tree = '((2:-26,(1:-4,(5:5,9:12)1:21)1:103)1:1,(4:-107,(8:-49,(0:-15,(7:-5,(3:6,6:5)1:14)1:31)1:67)1:114)1:1);'
     assert str(tree.write()) == exp_tree, str(tree.write())
 
 def test_init_tree():
@@ -108,7 +109,7 @@ def test_init_tree():
         nids.append(node.nid)
         sids.append(node.sid)
     assert nids == [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18]
-    assert sids == [[4], [2], [1], [5], [9], [5, 9], [1, 5, 9], [1, 2, 5, 9], [1, 2, 4, 5, 9], [8], [0], [7], [3], [6], [3, 6], [3, 6, 7], [0, 3, 6, 7], [0, 3, 6, 7, 8], [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]]
+    assert sids == [[2], [1], [5], [9], [5, 9], [1, 5, 9], [1, 2, 5, 9], [4], [8], [0], [7], [3], [6], [3, 6], [3, 6, 7], [0, 3, 6, 7], [0, 3, 6, 7, 8], [0, 3, 4, 6, 7, 8], [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]]
     
 def test_populate_tree_PL():    
     input_vcf = 'test_tree.vcf'
@@ -159,4 +160,492 @@ def test_calc_mut_likelihoods():
     tree = populate_tree_PL(tree, PLs, mm0, 'PL0')  #tree has PLs for no mutation at tips and nodes
     tree = calc_mut_likelihoods(tree, mm0, mm1)  #attach PLm to each node (not tips!)
     
-    
\ No newline at end of file
+    
+def test_recursive_NNI_budget():
+    input_vcf = 'test_tree.vcf'
+    vcffile, variants, ADs, PLs = read_vcf(input_vcf, 60)
+
+    GTYPE3 = np.array(('RR','RA','AA'))
+    base_prior = make_base_prior(30, GTYPE3)
+    mm,mm0,mm1 = make_mut_matrix_gtype3(80)
+
+    PLs = PLs.astype(np.longdouble)
+    n_site,n_smpl,n_gtype = PLs.shape
+
+    D = make_D(PLs)
+    tree = init_star_tree(n_smpl)
+    internals = np.arange(n_smpl)
+    D,tree = neighbor_joining(D.copy(), tree, internals)
+
+    tree = init_tree(tree)
+    tree = populate_tree_PL(tree, PLs, mm0, 'PL0')
+    tree = calc_mut_likelihoods(tree, mm0, mm1)
+    PL0 = score(tree, base_prior)
+
+    budget = SearchBudget(evals=5)
+    budget.start(1)
+    best_tree,best_PL = recursive_NNI(tree.copy(), PLs, mm0, mm1, base_prior, 0.0001, budget)
+
+    assert budget.n_evals == 5
+    assert budget.expired() and budget.exhausted()
+    assert best_PL <= PL0
+    assert np.isclose(score(best_tree, base_prior), best_PL)
+
+def test_make_D_pairwise():
+    input_vcf = 'test_tree.vcf'
+    vcffile, variants, ADs, PLs = read_vcf(input_vcf, 60)
+    PLs = PLs.astype(np.longdouble)
+    n_site,n_smpl,n_gtype = PLs.shape
+
+    exp_D = np.zeros((2*n_smpl-2,2*n_smpl-2), dtype=np.longdouble)
+    for i in xrange(n_smpl):
+        for j in xrange(n_smpl):
+            if i != j:
+                exp_D[i,j] = pairwise_diff(PLs, i, j)
+
+    assert np.allclose(make_D(PLs), exp_D)
+    assert np.allclose(make_D(PLs, block=7), exp_D)
+
+def test_nj_joins_bounded():
+    np.random.seed(1)
+    m = 60
+    d = np.random.rand(m,m)*100
+    d = d + d.T
+    np.fill_diagonal(d, 0)
+    D = np.zeros((2*m-2,2*m-2), dtype=np.longdouble)
+    D[:m,:m] = d
+    D1 = D.copy()
+    D2 = D.copy()
+
+    joins = list(nj_joins(D1, np.arange(m)))
+    joins_bounded = list(nj_joins_bounded(D2, np.arange(m), k=4))
+
+    # the last two joins (4 and 3 nodes left) are ties
+    assert [j[:3] for j in joins[:-2]] == [j[:3] for j in joins_bounded[:-2]]
+    assert np.allclose([j[3:] for j in joins[:-2]], [j[3:] for j in joins_bounded[:-2]])
+    assert np.allclose(D1[:-4,:-4], D2[:-4,:-4])
+
+def test_save_load_D(tmpdir):
+    input_vcf = 'test_tree.vcf'
+    vcffile, variants, ADs, PLs = read_vcf(input_vcf, 60)
+    PLs = PLs.astype(np.longdouble)
+    n_site,n_smpl,n_gtype = PLs.shape
+    D = make_D(PLs)
+
+    filename = str(tmpdir.join('test.dist.npz'))
+    save_D(filename, D, vcffile.samples, n_site)
+    assert np.array_equal(load_D(filename, vcffile.samples, n_site), D)
+
+    for samples,n in ((vcffile.samples[::-1], n_site), (vcffile.samples, n_site-1)):
+        try:
+            load_D(filename, samples, n)
+            assert False, 'mismatch not detected'
+        except ValueError:
+            pass
+
+def test_calc_minimum_pt_cost_gray():
+    input_vcf = 'test_tree.vcf'
+    vcffile, variants, ADs, PLs = read_vcf(input_vcf, 60)
+    PLs = PLs.astype(np.longdouble)
+
+    for k in (np.arange(3), np.arange(5), np.arange(10), np.array([1,4,6,7,9])):
+        for pls in (PLs[:,k], PLs[:,k,0:2]):
+            pt, cost = calc_minimum_pt_cost(pls, make_selection_matrix2(len(k)), 60)
+            pt_gray, cost_gray = calc_minimum_pt_cost_gray(pls, 60)
+            assert np.array_equal(pt, pt_gray)
+            assert cost == cost_gray
+
+def test_calc_minimum_pt_cost_spectral():
+    input_vcf = 'test_tree.vcf'
+    vcffile, variants, ADs, PLs = read_vcf(input_vcf, 60)
+    PLs = PLs.astype(np.longdouble)
+
+    for pls in (PLs, PLs[...,0:2], PLs[:,[1,4,6,7,9]]):
+        pt, cost = calc_minimum_pt_cost_spectral(pls, 60)
+        pt_gray, cost_gray = calc_minimum_pt_cost_gray(pls, 60)
+        assert pt[0] == 0 and 0 < pt.sum() < len(pt)
+        assert cost == partition_cost(pls[:,pt==0].sum(axis=1), pls[:,pt==1].sum(axis=1), 60)
+        assert cost == cost_gray
+
+def test_calc_minimum_pt_cost_batch():
+    input_vcf = 'test_tree.vcf'
+    vcffile, variants, ADs, PLs = read_vcf(input_vcf, 60)
+    PLs = PLs.astype(np.longdouble)
+
+    np.random.seed(0)
+    smat = list(np.random.randint(0, 2, (300, 10)).astype(np.byte))
+    exp_cost = np.inf
+    for k in smat:
+        c = partition_cost(PLs[:,k==0].sum(axis=1), PLs[:,k==1].sum(axis=1), 60)
+        if c < exp_cost:
+            exp_cost, exp_pt = c, k
+
+    for batch in (2**22, 1000):
+        pt, cost = calc_minimum_pt_cost(PLs, smat, 60, batch)
+        assert np.array_equal(pt, exp_pt)
+        assert cost == exp_cost
+
+    b = 1000//(PLs.shape[0]*PLs.shape[2])  # vectors per block
+    pt, cost = calc_minimum_pt_cost(PLs, smat, 60, 1000, SearchBudget(seconds=0))  # expired: first block only
+    assert cost == min(partition_cost(PLs[:,k==0].sum(axis=1), PLs[:,k==1].sum(axis=1), 60) for k in smat[:b])
+
+def test_partition_parallel():
+    import multiprocessing
+    input_vcf = 'test_tree.vcf'
+    vcffile, variants, ADs, PLs = read_vcf(input_vcf, 60)
+    PLs = PLs.astype(np.longdouble)
+
+    tree = Tree()
+    partition(PLs, tree, np.arange(10), 60)
+    pool = multiprocessing.Pool(2)
+    tree_parallel = Tree()
+    partition_parallel(PLs, tree_parallel, np.arange(10), 60, 'random', pool, 2)
+    pool.close()
+    pool.join()
+
+    assert tree.write(format=9) == tree_parallel.write(format=9)
+
+def test_calc_compat_tiles():
+    from treecall import calc_compat
+    np.random.seed(1)
+    PLs = np.random.randint(0, 60, (50,6,3))
+    PLs[...,0][np.random.rand(50,6)<0.6] = 0
+    PLs[:3,:,0] = 0
+    PLs[3:6,:,0] = 5
+    gt = (PLs[...,0]==0).astype(np.byte)
+    non_zeros = np.where(gt==1, PLs[...,1], PLs[...,0])
+    expected = np.zeros((50,50), dtype=np.int32)
+    for i in xrange(50):
+        expected[i,i:] = map(min, map(np.bincount, 2*gt[i]+gt[i:], np.minimum(non_zeros[i], non_zeros[i:])))
+    expected = expected + expected.T - np.diag(expected.diagonal())
+    assert np.array_equal(calc_compat(PLs), expected)
+    assert np.array_equal(calc_compat(PLs, block=7), expected)
+
+def test_pack_gt_popcount():
+    from treecall import pack_gt, popcount
+    gt = (np.random.rand(5,70) < 0.3).astype(np.byte)
+    bits = pack_gt(gt)
+    assert bits.shape == (5,2) and bits.dtype == np.uint64
+    assert np.array_equal(popcount(bits), gt.sum(axis=1))
+    assert np.array_equal(popcount(bits[:,None] & bits[None]), np.dot(gt.astype(int), gt.T))
+
+def test_calc_compat_out_pool(tmpdir):
+    import multiprocessing
+    from treecall import calc_compat
+    input_vcf = 'test_tree.vcf'
+    vcffile, variants, ADs, PLs = read_vcf(input_vcf, 60)
+    expected = calc_compat(PLs)
+    out = np.lib.format.open_memmap(str(tmpdir.join('c.npy')), mode='w+', dtype=np.int32, shape=expected.shape)
+    pool = multiprocessing.Pool(2)
+    calc_compat(PLs, block=16, out=out, pool=pool)
+    pool.terminate()
+    out.flush()
+    assert np.array_equal(np.load(str(tmpdir.join('c.npy')), mmap_mode='r'), expected)
+
+def test_tree2adjacency():
+    from treecall import tree2adjacency
+    tree = Tree()
+    tree.populate(30)
+    tree.children[0].add_child(name='x') # multifurcation
+    leaf_idx = {l:i for i,l in enumerate(tree.get_leaf_names())}
+    expected = np.zeros((31,31))
+    for l1 in tree.get_leaves():
+        for l2 in tree.get_leaves():
+            expected[leaf_idx[l1.name],leaf_idx[l2.name]] = l1.get_distance(l2, topology_only=True)
+    assert np.array_equal(tree2adjacency(tree, leaf_idx), expected)
+
+def test_compare_splits():
+    from treecall import split_bits, tree_splits, compare_splits
+    for n1,n2 in ((12,12), (12,10), (4,4)):
+        ref = Tree()
+        ref.populate(n1)
+        tree = Tree()
+        tree.populate(n2)
+        tree.get_leaves()[0].up.delete() # a polytomy
+        leaf_bit = split_bits(set(ref.get_leaf_names()) & set(tree.get_leaf_names()))
+        expected = ref.compare(tree, unrooted=True)
+        result = compare_splits(tree_splits(tree, leaf_bit), tree_splits(ref, leaf_bit), len(leaf_bit))
+        assert result == (expected['norm_rf'], expected['ref_edges_in_source'], expected['source_edges_in_ref'])
+
+def test_compare_tree_leaves_differ():
+    from treecall import init_compare, compare_tree
+    init_compare('((A,B),(C,(D,E)));')
+    row = compare_tree(('t', '((A,B),(C,(D,F)));')).split('\t')  # same tree on the shared A,B,C,D
+    assert row[0] == 't' and float(row[1]) == 0 and float(row[4]) == 0
+    expected = compare_tree(('t', '((A,C),(B,(D,E)));'))
+    assert compare_tree(('t', '(((A,G),C),(B,(D,E)));')) == expected
+    assert compare_tree(('t', '(A,(X,Y));')) is None
+
+def test_read_newick_stream(tmpdir):
+    from treecall import read_newick_stream
+    f = tmpdir.join('trees.nwk')
+    f.write('((A,B),C);\n\n(A,(B,C));\n')
+    trees = list(read_newick_stream(str(f)))
+    assert [name for name,nwk in trees] == ['%s:1' % f, '%s:3' % f]
+    assert Tree(trees[1][1]).get_leaf_names() == ['A', 'B', 'C']
+
+def test_genotype():
+    from geno import read_vcf_records, genotype, GTCALL_DTYPE, GTYPE10
+    tree = Tree('((((0,1),2),(3,4)),((5,6),((7,8),9)));')
+    leaves = tree.get_leaf_names()
+    for node in tree.iter_leaves():
+        node.name = leaves.index(node.name)
+    tree = init_tree(tree)
+    variants, ADs, PLs = read_vcf_records('test_tree.vcf')
+    mm,mm0,mm1 = make_mut_matrix_gtype10(80)
+    records,score = genotype(PLs, tree, variants, mm, mm0, mm1, make_base_prior(30, GTYPE10), leaves)
+
+    assert records.dtype == np.dtype(GTCALL_DTYPE) and len(records) == 65
+    assert abs(score - 15.06) < 0.01
+    r = records[1]
+    assert (r['chrom'], r['pos'], r['ref'], r['null_base'], r['mut_base'], r['mut_alt'], r['mut_loc'], r['mut_smpl']) == \
+        ('chr22', 2229, 'C', 'CC', 'CC', 'AC', 5, '3')
+    assert abs(r['mut_p'] - 1.05e-2) < 1e-4 and abs(r['null_p'] + r['mut_p'] - 1) < 1e-6
+
+def test_read_vcf_records_no_sites(tmpdir):
+    from geno import read_vcf_records
+    f = tmpdir.join('empty.vcf')
+    f.write(''.join(line for line in open('test_tree.vcf') if line.startswith('#')))
+    with pytest.raises(ValueError):
+        read_vcf_records(str(f))
+
+def test_tree_likelihoods():
+    from geno import read_vcf_records
+    variants, ADs, PLs = read_vcf_records('test_tree.vcf')
+    tree = init_tree(Tree('((((0,1),2),(3,4)),((5,6),((7,8),9)));'))
+    mm,mm0,mm1 = make_mut_matrix_gtype10(80)
+    PL,PL0,PLm = tree_likelihoods(tree, PLs, mm, mm0, mm1)
+    assert not hasattr(tree, 'PL0')
+
+    expected = populate_tree_PL(tree.copy(), PLs, mm, 'PL')
+    assert np.array_equal(PL, expected.PL)
+    expected = calc_mut_likelihoods(populate_tree_PL(tree.copy(), PLs, mm0, 'PL0'), mm0, mm1)
+    assert np.array_equal(PLm, expected.PLm)
+    for node,expected_node in zip(tree.traverse(), expected.traverse()):
+        assert np.array_equal(PL0[node], expected_node.PL0)
+
+def test_genotype_groups():
+    from geno import genotype_groups, GTYPE10
+    variants = np.array([('1','1','G','T'), ('1','2','C','A,T'), ('1','3','T','G'), ('1','4','A','C')])
+    groups = [(list(sites), list(GTYPE10[gt])) for sites,gt in genotype_groups(variants, GTYPE10)]
+    assert groups == [([1], list(GTYPE10)), ([3], ['AA','AC','CC']), ([0,2], ['GG','GT','TT'])]
+
+def test_write_gtcall(tmpdir):
+    from geno import GTCALL_DTYPE, write_gtcall, iter_vcf_records
+    from treecall import read_gtcall
+    assert [(len(PLs),len(v)) for variants,ADs,PLs,v in iter_vcf_records('test_tree.vcf', 30)] == [(30,30), (30,30), (5,5)]
+    records = np.zeros(2, dtype=GTCALL_DTYPE)
+    records['chrom'] = 'chr22'
+    records['pos'] = [1504, 2229]
+    records['ref'] = 'G'
+    records['null_base'],records['mut_base'],records['mut_alt'] = 'GG','GG','GT'
+    records['mut_p'] = [0.25, 1e-5]
+    records['mut_smpl'] = ['1', '3,4']
+    f = tmpdir.join('calls.txt')
+    with open(str(f), 'w') as fout:
+        write_gtcall(fout, records)
+    assert f.read().split('\n')[1].split('\t')[:5] == ['chr22', '2229', 'G', '0.00e+00', '1.00e-05']
+    assert np.array_equal(read_gtcall(str(f)), records)
+
+def test_write_gtcall_vcf(tmpdir):
+    import vcf
+    from geno import GTCALL_DTYPE, GTCALL_INFO, write_gtcall_vcf, iter_vcf_records
+    reader = vcf.Reader(open('test_tree.vcf'))
+    for key,num,typ,desc in GTCALL_INFO:
+        reader.infos[key] = vcf.parser._Info(key, num, typ, desc, None, None)
+    f = tmpdir.join('calls.vcf')
+    with open(str(f), 'w') as fout:
+        writer = vcf.Writer(fout, reader)
+        variants, ADs, PLs, vcf_records = next(iter_vcf_records(reader, 2))
+        records = np.zeros(2, dtype=GTCALL_DTYPE)
+        records['mut_p'] = [0.25, 1e-5]
+        records['mut_loc'] = [3, 0]
+        records['mut_smpl'] = ['1', '3,4']
+        write_gtcall_vcf(writer, vcf_records, records)
+    v = list(vcf.Reader(open(str(f))))
+    assert [r.POS for r in v] == [1504, 2229]
+    assert v[1].INFO['MUT_P'] == 1e-5 and v[1].INFO['MUT_LOC'] == 0 and v[1].INFO['MUT_SMPL'] == ['3','4']
+
+def test_iter_gtcall(tmpdir):
+    from treecall import iter_gtcall, read_gtcall
+    f = tmpdir.join('calls.txt')
+    f.write('chr22\t1504\tG\t5.86e-01\t4.14e-01\tGG\t5.86e-01\tGG\tGT\t3.90e-01\t1\t1\n\n'
+            'chr22\t2229\tC\t9.90e-01\t1.05e-02\tCC\t9.90e-01\tCC\tAC\t1.05e-02\t5\t3,4\n'
+            'chr22\t3689\tG\t9.23e-01\t7.73e-02\tGG\t9.23e-01\tGG\tCG\t7.73e-02\t1\t1\n')
+    assert [len(c) for c in iter_gtcall(str(f), 2)] == [2, 1]
+    gtcall = read_gtcall(str(f))
+    assert list(gtcall['pos']) == [1504, 2229, 3689] and list(gtcall['mut_smpl']) == ['1', '3,4', '1']
+    assert gtcall['mut_p'][1] == 1.05e-2
+
+def test_profile(tmpdir):
+    import json
+    make_D(np.zeros((4,3,3)))  # PROFILE is off: a plain call, nothing recorded
+    assert PROFILE.stages == {}
+    PROFILE.enable()
+    try:
+        make_D(np.zeros((4,3,3)))
+        make_D(np.zeros((4,3,3)))
+        with PROFILE.stage('block'):
+            pass
+        PROFILE.write(str(tmpdir.join('p.json')))
+        PROFILE.write(str(tmpdir.join('p.tsv')))
+    finally:
+        PROFILE.__init__()
+    report = json.load(open(str(tmpdir.join('p.json'))))
+    assert [(s['stage'], s['count']) for s in report['stages']] == [('make_D', 2), ('block', 1)]
+    assert report['max_rss_kb'] > 0
+    lines = tmpdir.join('p.tsv').read().splitlines()
+    assert lines[0] == '#stage\tcount\tseconds\tmax_rss_kb' and lines[1].startswith('make_D\t2\t')
+
+def test_profile_pool():
+    import multiprocessing
+    from treecall import calc_compat
+    vcffile, variants, DPRs, PLs = read_vcf('test_tree.vcf', 60)
+    PROFILE.enable()
+    pool = multiprocessing.Pool(2)  # forked with PROFILE on, as by --profile
+    try:
+        calc_compat(PLs, block=8, pool=pool)
+        stages = dict((k, v[0]) for k,v in PROFILE.stages.items())
+    finally:
+        PROFILE.__init__()
+        pool.terminate()
+    n_block = (len(PLs)+7)//8
+    assert stages == {'calc_compat': 1, 'compat_tile': n_block*(n_block+1)//2}  # tiles timed by the workers
+
+def test_progress(tmpdir):
+    import json
+    from utils import Progress
+    progress = Progress()
+    progress.configure(interval=3600, quiet=True, log=str(tmpdir.join('p.log')))
+    progress.start('task', 'sites', 10)
+    progress.update(4)
+    progress.finish()  # within the interval: nothing written
+    progress.configure(interval=0, quiet=True, log=str(tmpdir.join('p.log')))
+    progress.start('task', 'trees', 10)
+    progress.update(4, best=12.5)
+    progress.finish()
+    progress.configure()
+    lines = [json.loads(l) for l in tmpdir.join('p.log').read().splitlines()]
+    assert [(l['state'], l['done'], l['unit']) for l in lines] == [('running', 4, 'trees'), ('done', 4, 'trees')]
+    assert lines[0]['total'] == 10 and lines[0]['best'] == 12.5
+
+    progress.configure(interval=0, quiet=True, log=str(tmpdir.join('n.log')))
+    progress.start('partition', 'splits', 3)
+    progress.update()
+    progress.start('split', 'candidates', 8)  # nested: reported in place of partition until it finishes
+    progress.update(8, best=1.5)
+    progress.finish()
+    progress.update()
+    progress.finish()
+    progress.configure()
+    lines = [json.loads(l) for l in tmpdir.join('n.log').read().splitlines()]
+    assert [(l['task'], l['state'], l['done']) for l in lines] == \
+        [('partition', 'running', 1), ('split', 'running', 8), ('split', 'done', 8), ('partition', 'running', 2), ('partition', 'done', 2)]
+    assert progress.task is None
+
+def test_read_vcf_data():
+    from pipeline import read_vcf_data
+    from geno import read_vcf_records
+    samples, variants, ADs, PLs, PL10s = read_vcf_data('test_tree.vcf')
+    vcffile, variants3, ADs3, PLs3 = read_vcf('test_tree.vcf')
+    variants10, ADs10, PLs10 = read_vcf_records('test_tree.vcf')
+    assert samples == vcffile.samples
+    assert np.array_equal(variants, variants10) and np.array_equal(variants[:,:3], variants3)
+    assert np.array_equal(ADs, ADs3) and np.array_equal(PLs, PLs3) and np.array_equal(PL10s, PLs10)
+
+def test_run_pipeline(tmpdir):
+    from pipeline import run_pipeline
+    out = str(tmpdir.join('x'))
+    best_PL, tree, calls = run_pipeline('test_tree.vcf', out, max_evals=20, nsite=30)
+    assert sorted(tree.get_leaf_names(), key=int) == map(str, range(10))
+    assert len(calls) == 65 and tmpdir.join('x.gtcall.txt').read().count('\n') == 65
+    assert tmpdir.join('x.best.tre').check() and tmpdir.join('x.annot.tre').check()
+
+def attached_files(a):
+    """attach() a SharedArray in a pool worker, returns the files the worker has mapped and the sum of a"""
+    from utils import attach, ATTACHED
+    total = float(attach(a).sum())
+    return sorted(ATTACHED), total
+
+def test_shared_array():
+    import os, time, pickle, signal, subprocess, multiprocessing
+    from utils import SharedArray, attach
+    PLs = np.arange(24, dtype=np.longdouble).reshape(2,3,4)
+    with SharedArray(PLs) as shared:
+        copy = pickle.loads(pickle.dumps(shared, 2))  # as sent to a worker
+        assert np.array_equal(attach(copy), PLs) and attach(copy).dtype == np.longdouble
+        assert os.path.exists(shared.filename)
+    assert not os.path.exists(shared.filename)
+
+    from utils import SHARED_FILES
+    pool = multiprocessing.Pool(1)
+    try:
+        with SharedArray(PLs) as a:
+            assert pool.apply(attached_files, (a,)) == ([a.filename], PLs.sum())
+        with SharedArray(PLs) as b:  # the worker unmaps a, removed since
+            assert pool.apply(attached_files, (b,)) == ([b.filename], PLs.sum())
+        c = SharedArray(PLs+1)  # a new array that gets the file name of b
+        os.rename(c.filename, b.filename)
+        SHARED_FILES[b.filename] = SHARED_FILES.pop(c.filename)
+        c.filename = b.filename
+        with c:
+            assert pool.apply(attached_files, (c,)) == ([c.filename], (PLs+1).sum())
+    finally:
+        pool.terminate()
+
+    repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    for sig in (signal.SIGINT, signal.SIGTERM):  # removed when the process that made it is stopped
+        p = subprocess.Popen([sys.executable, '-c',
+            "import sys, time\n"
+            "sys.path.insert(0, %r)\n"
+            "import numpy as np\n"
+            "from utils import SharedArray\n"
+            "sys.stdout.write(SharedArray(np.zeros(10)).filename + '\\n')\n"
+            "sys.stdout.flush()\n"
+            "time.sleep(30)\n" % repo], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            filename = p.stdout.readline().strip()
+            assert filename and os.path.exists(filename)
+            p.send_signal(sig)
+            deadline = time.time() + 10
+            while p.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            assert p.returncode is not None, ('not stopped by', sig)
+        finally:
+            if p.poll() is None:
+                p.kill()
+            p.communicate()
+        assert p.returncode != 0 and not os.path.exists(filename), sig
+
+def test_cli_startup(tmpdir):
+    """scipy, all of ete2 (only its core Tree, see lazy_tree) and pyvcf are not loaded by -h, by the
+    tree-only sub-commands nor by importing the modules, and these run in well under a second"""
+    import os, subprocess
+    repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    def run(code, modules):
+        """modules of these loaded after running code, and its seconds (not counting python's start)"""
+        out = subprocess.check_output([sys.executable, '-c', "import sys, time\n"
+                                       "sys.path.insert(0, %r)\n" % repo +
+                                       "t = time.time()\n" + code +
+                                       "\nsys.stdout.write('\\n%%s %%.3f' %% ([m for m in %r if m in sys.modules], time.time()-t))" % (modules,)],
+                                      stderr=subprocess.STDOUT)
+        loaded,seconds = out.strip().splitlines()[-1].rsplit(' ', 1)
+        return loaded, float(seconds)
+    def treecall(*args):
+        return ("import runpy\n"
+                "sys.argv = ['treecall.py'] + %r\n"
+                "try: runpy.run_path(%r, run_name='__main__')\n"
+                "except SystemExit: pass" % (list(args), os.path.join(repo, 'treecall.py')))
+    for cmd in ('tview', 'compare', 'compat', 'nbjoin', 'gtype', 'annot', 'pipeline'):
+        loaded,seconds = run(treecall(cmd, '-h'), ('ete2', 'scipy', 'vcf'))
+        assert loaded == '[]' and seconds < 1.0, (cmd, loaded, seconds)
+    tree = tmpdir.join('t.nwk')
+    tree.write('((0,1),(2,(3,4)));\n')
+    tmpdir.join('calls.txt').write('')
+    for args in (('tview', str(tree)), ('compare', '-t', str(tree), '-r', str(tree)),
+                 ('annot', str(tmpdir.join('calls.txt')), str(tmpdir.join('a.nwk')), '-t', str(tree))):
+        loaded,seconds = run(treecall(*args), ('ete2.clustering', 'scipy', 'vcf'))
+        assert loaded == '[]' and seconds < 1.0, (args, loaded, seconds)
+    for module in ('utils', 'geno', 'tree_est', 'pipeline'):
+        loaded,seconds = run('import %s' % module, ('ete2', 'scipy', 'vcf'))
+        assert loaded == '[]', (module, loaded)
@@ -10,20 +10,61 @@ import signal
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 import sys
+import time
 import itertools
+import multiprocessing
 import numpy as np
-from scipy.stats import sem
-import vcf
 
 from utils import *
 
-with warnings.catch_warnings(ImportWarning):
-    from ete2 import Tree
-
 warnings.filterwarnings('error')
 
 DELTA=0.0001  #move this so it's not global
 
+class SearchBudget(object):
+    """Wall-clock and tree evaluation limits shared by all starting trees of a search
+
+    Args:
+        seconds (float): total wall-clock time allowed, None for no limit
+        evals (int): total number of candidate trees that may be scored, None for no limit
+
+    Each starting tree gets an even share of what is left when it begins (start()),
+    so time or evaluations not used by one start roll over to the next.
+    """
+
+    def __init__(self, seconds=None, evals=None):
+        self.deadline = None if seconds is None else time.time() + seconds
+        self.max_evals = evals
+        self.n_evals = 0
+        self.start_deadline = self.deadline
+        self.start_evals = evals
+
+    def start(self, n_left):
+        """set the limits for the next starting tree given n_left starts remain (incl. this one)"""
+        if self.deadline is not None:
+            now = time.time()
+            self.start_deadline = now + max(self.deadline-now, 0)/n_left
+        if self.max_evals is not None:
+            share = max(self.max_evals-self.n_evals, 0)//n_left
+            self.start_evals = min(self.n_evals + max(share, 1), self.max_evals)
+
+    def count(self):
+        """record one candidate tree evaluation"""
+        self.n_evals += 1
+
+    def expired(self):
+        """limit for the current starting tree reached"""
+        if self.start_deadline is not None and time.time() >= self.start_deadline:
+            return True
+        return self.start_evals is not None and self.n_evals >= self.start_evals
+
+    def exhausted(self):
+        """limit for the whole search reached"""
+        if self.deadline is not None and time.time() >= self.deadline:
+            return True
+        return self.max_evals is not None and self.n_evals >= self.max_evals
+
+
 def neighbor_main(args):
     """generate neighbor-joining tree then do recursive NNI and recursive reroot
 
@@ -35,18 +76,41 @@ def neighbor_main(args):
         het (int): heterozygous rate in Phred scale, default 30
         min_ev(int): minimum evidence in Phred scale for a site to be considered
             default 60
+        split (str): how the partition starting tree splits more than 20 samples (more than 10 with spectral), 'random' or 'spectral'
+        processes (int): number of processes building the partition starting tree, default 1
+        dist (str): sample distance matrix saved by an earlier run (save_dist), used instead of make_D
+        save_dist (str): file to save the sample distance matrix to
+        time_budget (float): wall-clock seconds for the whole search, default no limit
+        max_evals (int): number of candidate trees scored in the whole search, default no limit
     
     Output:
         newick trees
+        best tree found across starting trees (output.best.tre, output.bestnames.tre),
+            rewritten each time it improves, so it is there even if the search is stopped
+            by --time-budget/--max-evals or the run is killed
     
     """
-   
     print(args, file=sys.stderr)
     vcffile, variants, DPRs, PLs = read_vcf(args.vcf, args.min_ev)
     #variants =  np.array (tuple): variant info (chrom, pos, ref)  for each variant
     #DPRs = np.array (int): Number of high-quality bases observed for each of the 2 most common alleles for each variant
     #PLs = np.array (int): List of Phred-scaled genotype likelihoods for each of the 2 most common alleles (3 genotypes) for each variant
-    
+    neighbor_search(PLs, vcffile.samples, args)
+
+def neighbor_search(PLs, samples, args):
+    """the search of neighbor_main() on PLs already read from the vcf
+
+    Args:
+        PLs (np.array): PLs of the 2 most common alleles (3 genotypes), from read_vcf
+        samples (list): sample names of the vcf
+        args: the options of neighbor_main() other than vcf
+
+    Returns:
+        (float, Tree): best score and best tree across starting trees (leaves named by sample number), None if no tree was searched
+    """
+    sem = lazy_import('scipy.stats').sem
+    Tree = lazy_tree()
+
     GTYPE3 = np.array(('RR','RA','AA'))
     base_prior = make_base_prior(args.het, GTYPE3) # base genotype prior; heterozygous rate in Phred scale, default 30; e.g. for het=30 [ 3.0124709,  33.012471,  3.0124709]
     mm,mm0,mm1 = make_mut_matrix_gtype3(args.mu) # substitution rate matrix, with non-diagonal set to 0, with diagonal set to 0
@@ -54,19 +118,40 @@ def neighbor_main(args):
     PLs = PLs.astype(np.longdouble)
     n_site,n_smpl,n_gtype = PLs.shape
 
-    D = make_D(PLs)  # pairwise differences between samples based only on PLs (should include mutation, but also shouldn't matter)
+    if args.dist:
+        try:
+            D = load_D(args.dist, samples, n_site)  # precomputed by an earlier run with --save-dist
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    else:
+        D = make_D(PLs)  # pairwise differences between samples based only on PLs (should include mutation, but also shouldn't matter)
+    if args.save_dist:
+        save_D(args.save_dist, D, samples, n_site)
     allscores = []
+    best = None  #(PL, tree) best across starting trees
+
+    budget = None
+    starts = range(n_smpl+2)
+    if args.time_budget is not None or args.max_evals is not None:
+        budget = SearchBudget(args.time_budget, args.max_evals)
+        starts = starts[n_smpl:] + starts[:n_smpl]  #informed starting trees (nj, partition) first
     
     fo = open(args.output+'.scores.txt','w')
     
-    for i in range(n_smpl+2):  #10 different starting trees
+    for n_done,i in enumerate(starts):  #10 different starting trees
+        if budget is not None:
+            if budget.exhausted():
+                print('budget exhausted after %d of %d starting trees' % (n_done, n_smpl+2), file=sys.stderr)
+                break
+            budget.start(len(starts)-n_done)
         print('Tree '+str(i+1)+' of '+str(n_smpl+2))
         tree = init_star_tree(n_smpl)
         internals = np.arange(n_smpl)
         
         #2nd to last tree is nj tree (tho with raw scores not adjusted for saturation)
         if i == n_smpl:
-            D,tree = neighbor_joining(D.copy(), tree.copy(), internals) #haven't checked this; make nj tree and update D given internal nodes; pass copy
+            D,tree = neighbor_joining(D.copy(), tree.copy(), internals, args.nj_bounded) #haven't checked this; make nj tree and update D given internal nodes; pass copy
             
         #last tree is partition tree
         elif i == n_smpl+1:
@@ -74,9 +159,18 @@ def neighbor_main(args):
             #sem calculates the standard error of the mean
             #check if sem for col 1
             if sem(PLs[...,1],axis=1).mean() > sem(PLs[...,2],axis=1).mean():  
-                partition(PLs[...,0:2], tree, np.arange(n_smpl), args.min_ev)
+                pt_PLs = PLs[...,0:2]
             else:
-                partition(PLs, tree, np.arange(n_smpl), args.min_ev)
+                pt_PLs = PLs
+            with PROFILE.stage('partition'):
+                if args.processes > 1:
+                    pool = multiprocessing.Pool(args.processes)
+                    try:
+                        partition_parallel(pt_PLs, tree, np.arange(n_smpl), args.min_ev, args.split, pool, args.processes, budget)
+                    finally:
+                        pool.terminate()
+                else:
+                    partition(pt_PLs, tree, np.arange(n_smpl), args.min_ev, args.split, budget)
             
         #all other trees are semi-random
         else:
@@ -91,26 +185,44 @@ def neighbor_main(args):
         
         rerooted = 1
         while rerooted > 0:
-            best_tree,best_PL = recursive_NNI(tree.copy(), PLs, mm0, mm1, base_prior,DELTA)
+            best_tree,best_PL = recursive_NNI(tree.copy(), PLs, mm0, mm1, base_prior,DELTA,budget)
             #print(best_tree)
-            best_tree,best_PL,rerooted = recursive_reroot(best_tree.copy(), PLs,mm0, mm1, base_prior,DELTA)  #why are brlens negative?
+            best_tree,best_PL,rerooted = recursive_reroot(best_tree.copy(), PLs,mm0, mm1, base_prior,DELTA,budget)  #why are brlens negative?
             #print(best_tree)
             print('PL_per_site = %.4f' % (best_PL/n_site))
             best_tree.write(outfile=args.output+'.'+str(i)+'.tre', format=5)  #write best tree
+            if best is None or best_PL < best[0]:
+                best = (best_PL, best_tree.copy())
+                write_best_tree(best[1], samples, args.output)  #kept up to date in case the run is killed
             #replace sample numbers with actual names
             for node in best_tree.traverse("postorder"):
                 if node.is_leaf():
-                    node.name=vcffile.samples[int(node.name)]
+                    node.name=samples[int(node.name)]
                 
             best_tree.write(outfile=args.output+'.'+str(i)+'names.tre', format=5)  #write best tree
             fo.write(str(i) + ' ' + str(best_PL) + "\n")
+            fo.flush()
             allscores.append(best_PL)
-        i+=1
+            if budget is not None and budget.expired():
+                break
     
     print(allscores)
     
-    fo.close
-    
+    fo.close()
+    return best
+
+def write_best_tree(tree, samples, output):
+    """write the best tree found by the search, with sample numbers and with sample names
+
+    Output to files:
+        output.best.tre, output.bestnames.tre
+    """
+    tree.write(outfile=output+'.best.tre', format=5)
+    tree = tree.copy()
+    for leaf in tree.iter_leaves():
+        leaf.name = samples[int(leaf.name)]
+    tree.write(outfile=output+'.bestnames.tre', format=5)
+
 def init_star_tree(n):
     """Creates a tree, adds n children in star with numbers as names
 
@@ -120,7 +232,7 @@ def init_star_tree(n):
     Returns:
         Tree: 
     """
-    
+    Tree = lazy_tree()
     tree = Tree()
     for i in xrange(n):
         tree.add_child(name=str(i))
@@ -143,13 +255,18 @@ def pairwise_diff(PLs, i, j):
     return (1-p.sum(axis=1)).sum()  
 
 
-def make_D(PLs):
+@profiled('make_D')
+def make_D(PLs, block=10000):
     """
     Get pairwise differences between samples based on PLs (e.g. for generating nj tree)
+
+    Same as pairwise_diff() for all pairs of samples: each sample is normalized once and
+    sum_g p_i*p_j for all pairs is a single tensordot over sites and genotypes
     
     Args:
         PLs (np.array (longdouble)): List of Phred-scaled genotype likelihoods
             for each of the 2 most common alleles for each variant
+        block (int): number of sites processed at once, bounds memory to block x m x g
         
     Returns:
         np.array (longdouble): matrix of n x n where n = number nodes in bifurcating tree
@@ -157,13 +274,63 @@ def make_D(PLs):
     """
     n,m,g = PLs.shape   #n_site,n_smpl,n_gtype
     D = np.zeros(shape=(2*m-2,2*m-2), dtype=np.longdouble) #2*m-2 = the total number of nodes of unrooted tree (incl leaves and internal)
-    for i,j in itertools.combinations(xrange(m),2):
-        D[i,j] = pairwise_diff(PLs, i, j)
-        D[j,i] = D[i,j]
+    if m < 2:
+        return D
+    same = np.zeros(shape=(m,m), dtype=np.longdouble) #sum over sites of P(same genotype) for each pair
+    block = max(int(block), 1)
+    for s in xrange(0, n, block):
+        p = phred2p(PLs[s:(s+block)].astype(np.longdouble)) # block x m x g
+        p /= p.sum(axis=2)[...,None] #normalize each sample at each site, as normalize2d_PL
+        same += np.tensordot(p, p, axes=([0,2],[0,2]))
+    d = n - same
+    np.fill_diagonal(d, 0.0)
+    D[:m,:m] = d
     return D
 
 
-def neighbor_joining(D, tree, internals):
+def save_D(filename, D, samples, n_site):
+    """Save the sample part of D from make_D, with what it was computed from
+
+    Args:
+        filename (str): output file (numpy .npz)
+        D (np.array): pairwise differences from make_D
+        samples (list): sample names, in the order of D
+        n_site (int): number of sites D was computed from
+    """
+    m = len(samples)
+    with open(filename, 'wb') as f:
+        np.savez(f, D=D[:m,:m], samples=np.array(samples), n_site=n_site)
+
+
+def load_D(filename, samples, n_site):
+    """Load D saved by save_D, checking it was computed for the same samples and number of sites
+
+    Args:
+        filename (str): file written by save_D
+        samples (list): sample names of the vcf
+        n_site (int): number of sites read from the vcf
+
+    Returns:
+        np.array (longdouble): pairwise differences as from make_D
+
+    Raises:
+        ValueError: samples or number of sites differ
+    """
+    f = np.load(filename)
+    saved_samples = list(f['samples'])
+    saved_n_site = int(f['n_site'])
+    if saved_samples != list(samples):
+        raise ValueError('%s: samples differ from vcf' % filename)
+    if saved_n_site != n_site:
+        raise ValueError('%s: computed from %d sites, vcf has %d' % (filename, saved_n_site, n_site))
+    m = len(samples)
+    D = np.zeros(shape=(2*m-2,2*m-2), dtype=np.longdouble)
+    D[:m,:m] = f['D']
+    return D
+
+
+@profiled('neighbor_joining')
+def neighbor_joining(D, tree, internals, bounded=False):
     #fsum will have better precision when adding distances across sites
     #based on PLs not mutation
     """
@@ -172,50 +339,168 @@ def neighbor_joining(D, tree, internals):
         D (np.array): pairwise differences between samples based on PLs (passing copy)
         tree (Tree): tree of class Tree with num tips = num samples
         internals (np.array): array of sample numbers
+        bounded (bool): find each pair to join with a RapidNJ-style bounded search (nj_joins_bounded)
+            instead of the full Q matrix (nj_joins); for large numbers of samples
         
     Returns:
         Tree
         D (np.array): update pairwise differences now there are internal nodes to compare
     
     """
-    print('neighbor_joining() begin', end=' ', file=sys.stderr)
+    Tree = lazy_tree()
+    PROGRESS.start('neighbor_joining', 'joins', len(internals)-2)
+    children = dict((c.name, c) for c in tree.children)
+    nodes = dict((k, children[str(k)]) for k in internals) #node number -> node, instead of searching tree by name
+
+    joins = nj_joins_bounded if bounded else nj_joins
+    for i,j,l,vi,vj in joins(D, np.asarray(internals)):
+        ci = nodes.pop(i).detach()
+        cj = nodes.pop(j).detach()
+        node = Tree(name=str(l))
+        node.add_child(ci,dist=int(vi))
+        node.add_child(cj,dist=int(vj))
+        tree.add_child(node)
+        nodes[l] = node
+        PROGRESS.update()
+
+    PROGRESS.finish()
+    return D,tree
+
+
+def nj_joins(D, internals):
+    """Neighbor-joining on D, one join at a time
+
+    Q is computed for all pairs at once; the distances between the remaining nodes are kept
+    in a compact matrix (ordered by node number, like internals) updated by rows and columns
+    
+    Args:
+        D (np.array): pairwise differences, updated in place with the distances of new nodes
+        internals (np.array): numbers of the nodes to join
+        
+    Yields:
+        tuple: numbers of the two nodes joined, number of the new node, branch lengths to the two nodes
+    """
     m = len(internals)
+    d = D[internals[:,None],internals]  #initially D matrix w/o 0 distance btwn internal nodes; then add in nodes as they have distances
+    lower = np.tri(m, dtype=bool)  #on and below the diagonal
     while m > 2:  #if m is 2 then only two connected to root
-        d = D[internals[:,None],internals]  #initially D matrix w/o 0 distance btwn internal nodes; then add in nodes as they have distances
         u = d.sum(axis=1)/(m-2)
 
-        Q = np.zeros(shape=(m,m), dtype=np.longdouble)
-        for i,j in itertools.combinations(xrange(m),2):  #std Q matrix calc
-            Q[i,j] = d[i,j]-u[i]-u[j]
-            Q[j,i] = Q[i,j]
-        #print(Q.astype(int))
-        np.fill_diagonal(Q, np.inf)
-        #print(np.unique(Q, return_counts=True))
+        Q = d - u[:,None] - u  #std Q matrix calc
+        np.copyto(Q, np.inf, where=lower[:m,:m])  #symmetric: only i<j, first min in row order as for the full matrix
         i,j = np.unravel_index(Q.argmin(), (m,m))  #location in matrix of smallest Q value (ie closest nodes/tips)
         l = len(D)+2-m
 
-        for k in xrange(m):
-            D[l,internals[k]] = D[internals[k],l] = d[i,k]+d[j,k]-d[i,j]
-        D[l,internals[i]] = D[internals[i],l] = vi = (d[i,j]+u[i]-u[j])/2
-        D[l,internals[j]] = D[internals[j],l] = vj = (d[i,j]+u[j]-u[i])/2
+        r = d[i]+d[j]-d[i,j]
+        r[i] = vi = (d[i,j]+u[i]-u[j])/2
+        r[j] = vj = (d[i,j]+u[j]-u[i])/2
+        D[l,internals] = D[internals,l] = r
+        yield internals[i], internals[j], l, vi, vj
 
-        ci = tree&str(internals[i])
-        cj = tree&str(internals[j])
-        ci.detach()
-        cj.detach()
-        node = Tree(name=str(l))
-        node.add_child(ci,dist=int(vi))
-        node.add_child(cj,dist=int(vj))
-        tree.add_child(node)
-        #print(tree)
+        #drop i and j, append l (the largest node number, so order is kept)
+        keep = np.ones(m, dtype=bool)
+        keep[[i,j]] = False
+        nd = np.empty((m-1,m-1), dtype=d.dtype)
+        nd[:-1,:-1] = d[np.ix_(keep,keep)]
+        nd[-1,:-1] = nd[:-1,-1] = r[keep]
+        nd[-1,-1] = D[l,l]
+        d = nd
+        internals = np.append(internals[keep], l)
+        m -= 1
 
-        internals = np.delete(internals, [i,j])
-        internals = np.append(internals, l)
-        m = len(internals)
-        print('.', end='', file=sys.stderr)
 
-    print(' done', file=sys.stderr)
-    return D,tree
+def nj_joins_bounded(D, internals, k=32):
+    """Neighbor-joining on D, one join at a time, with a RapidNJ-style bounded search for the pair
+
+    Distances are kept in a fixed matrix, one slot per node; a new node takes the slot of
+    the first node joined. Distances between existing nodes never change, so the k nearest
+    neighbors of each row are found once (and again after k new nodes) and only u changes:
+    Q is scored for those k columns and for the columns of nodes made since, and every
+    other entry of row a is bounded by Q >= kth[a] - u[a] - max(u of old nodes). Only rows
+    whose bound is below the best Q found are scored in full. Sums use float64 and row sums are updated
+    incrementally, so exact ties may be broken differently than nj_joins().
+    
+    Args:
+        D (np.array): pairwise differences, updated in place with the distances of new nodes
+        internals (np.array): numbers of the nodes to join
+        k (int): number of nearest neighbors kept for each row
+        
+    Yields:
+        tuple: numbers of the two nodes joined, number of the new node, branch lengths to the two nodes
+    """
+    m = len(internals)
+    idx = np.arange(m)
+    ids = np.array(internals) #node number in each slot
+    W = D[internals[:,None],internals].astype(np.float64)
+    np.fill_diagonal(W, 0.0)
+    active = np.ones(m, dtype=bool)
+    S = W.sum(axis=1)
+    new = [] #slots of nodes made since nearest neighbors were found
+    nn = None
+
+    while m > 2:
+        if nn is None or len(new) >= k:
+            x = np.where(active, W, np.inf)
+            x[idx,idx] = np.inf
+            kk = min(k, m-1)
+            nn = np.argpartition(x, kk-1, axis=1)[:,:kk] # k nearest columns of each row
+            nnd = x[idx[:,None],nn]
+            kth = np.where(m-1 > kk, nnd.max(axis=1), np.inf) # every other column is at least this far
+            kth[~active] = np.inf
+            new = []
+
+        u = S/(m-2)
+        old = active.copy()
+        old[new] = False
+        umax = u[old].max() if old.any() else -np.inf #only columns of old nodes need bounding
+        q = nnd - u[:,None] - u[nn]
+        q[~(active[:,None] & active[nn])] = np.inf
+        a,b = np.unravel_index(q.argmin(), q.shape)
+        best, i, j = q[a,b], a, nn[a,b]
+        if new:
+            cols = np.array(new)
+            q = W[:,cols] - u[:,None] - u[cols]
+            q[~active] = np.inf
+            q[cols,np.arange(len(cols))] = np.inf
+            a,b = np.unravel_index(q.argmin(), q.shape)
+            if q[a,b] < best:
+                best, i, j = q[a,b], a, cols[b]
+        rows = np.nonzero(kth - u - umax < best)[0]
+        if len(rows):
+            q = W[rows] - u[rows,None] - u
+            q[:,~active] = np.inf
+            q[np.arange(len(rows)),rows] = np.inf
+            a,b = np.unravel_index(q.argmin(), q.shape)
+            if q[a,b] < best:
+                best, i, j = q[a,b], rows[a], b
+        if ids[i] > ids[j]:
+            i,j = j,i
+        l = len(D)+2-m
+
+        dij = W[i,j]
+        r = W[i]+W[j]-dij
+        r[i] = vi = (dij+u[i]-u[j])/2
+        r[j] = vj = (dij+u[j]-u[i])/2
+        D[l,ids[active]] = D[ids[active],l] = r[active]
+        yield ids[i], ids[j], l, vi, vj
+
+        #slot i holds the new node, slot j is emptied
+        active[j] = False
+        r[~active] = 0.0
+        r[i] = 0.0
+        S += r - W[:,i] - W[:,j]
+        W[i,:] = W[:,i] = r
+        W[j,:] = W[:,j] = 0.0
+        S[i] = r.sum()
+        S[j] = 0.0
+        ids[i] = l
+        #nearest neighbors of and to the old node in slot i are gone, the new node is scored by its column
+        kth[i] = kth[j] = np.inf
+        nnd[i] = np.inf
+        nnd[nn == i] = np.inf
+        new = [c for c in new if c != i and c != j] + [i]
+        m -= 1
+
 
 def update_PL(node, mm0, mm1):
     """
@@ -257,6 +542,7 @@ def update_PL(node, mm0, mm1):
 
     return node
 
+@profiled('score')
 def score(tree, base_prior):
     """
     used to compare trees
@@ -274,69 +560,310 @@ def score(tree, base_prior):
     return p2phred(Pm+P0).sum()
 
 
-def partition(PLs, tree, sidx, min_ev):
+def partition(PLs, tree, sidx, min_ev, split='random', budget=None):
     """requires
-            make_selection_matrix2
-            calc_minimum_pt_cost
-            
+            split_node
+
+    once budget (SearchBudget) has expired, each split is the best of the candidates scored so far
     """
     
     if tree.is_root():
-        print('partition() begin', end=' ', file=sys.stderr)
+        PROGRESS.start('partition', 'splits', len(sidx)-1)
+    todo = split_node(PLs, tree, sidx, min_ev, split, budget)
+    PROGRESS.update()
+    for child,child_PLs,child_sidx in todo:
+        partition(child_PLs, child, child_sidx, min_ev, split, budget)
+    if tree.is_root():
+        PROGRESS.finish()
+
+
+def split_node(PLs, tree, sidx, min_ev, split='random', budget=None):
+    """one level of partition(): add the two groups of samples under tree as children
+
+    requires
+            calc_minimum_pt_cost_gray (up to 20 samples, 10 with split='spectral')
+            make_selection_matrix2, calc_minimum_pt_cost (more samples, split='random')
+            calc_minimum_pt_cost_spectral (more samples, split='spectral')
+
+    the candidates these score are reported as progress task split, within partition
+
+    Returns:
+        list: (child, PLs, sidx) for children that still have to be partitioned
+    """
     m = len(sidx) # number of samples under current node
-    print(m, end='.', file=sys.stderr)
+    todo = []
     if m == 2:
         child1 = tree.add_child(name=str(sidx[0]))
         child1.add_features(samples=np.atleast_1d(sidx[0]))
         child2 = tree.add_child(name=str(sidx[1]))
         child2.add_features(samples=np.atleast_1d(sidx[1]))
     elif m > 2:
-        smat = make_selection_matrix2(m)
-        pt, cost = calc_minimum_pt_cost(PLs, smat, min_ev)
+        if m <= (10 if split == 'spectral' else 20):
+            PROGRESS.start('split', 'candidates', 2**(m-1))
+            pt, cost = calc_minimum_pt_cost_gray(PLs, min_ev, budget=budget)
+        elif split == 'spectral':
+            PROGRESS.start('split', 'candidates')
+            pt, cost = calc_minimum_pt_cost_spectral(PLs, min_ev, budget=budget)
+        else:
+            PROGRESS.start('split', 'candidates', 2**20)
+            smat = make_selection_matrix2(m)
+            pt, cost = calc_minimum_pt_cost(PLs, smat, min_ev, budget=budget)
+        PROGRESS.finish(best=cost)
         k0 = pt==0
         sidx0 = np.atleast_1d(sidx[k0])
         child = tree.add_child(name=','.join(sidx0.astype(str)))
         child.add_features(samples=sidx0)
         if len(sidx0) > 1:
-            partition(PLs[:,k0,], child, sidx0, min_ev)
+            todo.append((child, PLs[:,k0,], sidx0))
         k1 = pt==1
         sidx1 = np.atleast_1d(sidx[k1])
         child = tree.add_child(name=','.join(sidx1.astype(str)))
         child.add_features(samples=sidx1)
         if len(sidx1) > 1:
-            partition(PLs[:,k1,], child, sidx1, min_ev)
+            todo.append((child, PLs[:,k1,], sidx1))
     else:
         print('m<=1: shouldn\'t reach here', file=sys.stderr)
         sys.exit(1)
-    if tree.is_root():
-        print(' done', file=sys.stderr)
+    return todo
 
 
-def calc_minimum_pt_cost(PLs, smat, min_ev):
+def partition_parallel(PLs, tree, sidx, min_ev, split, pool, n_jobs, budget=None):
+    """same as partition() with independent subtrees built by a process pool
+
+    The largest groups are split here until there are 2*n_jobs of them, each of these
+    is then partitioned by a worker (partition_subtree) and attached in place.
+
+    Args:
+        pool (multiprocessing.Pool): workers
+        n_jobs (int): number of workers in pool
+        budget (SearchBudget): as for partition(), its wall-clock limit also applies in the workers
+
+    The workers map PLs from a SharedArray and take the columns of their group; their time is
+    recorded as stage partition_subtree. Each group is given its own seed (drawn from np.random
+    here), as the forked workers would otherwise all draw the same random candidate splits.
+    """
+    PROGRESS.start('partition', 'splits', len(sidx)-1)
+    todo = [(tree, PLs, sidx)]
+    while todo and len(todo) < 2*n_jobs:
+        k = max(xrange(len(todo)), key=lambda i: len(todo[i][2]))
+        node,node_PLs,node_sidx = todo.pop(k)
+        todo[k:k] = split_node(node_PLs, node, node_sidx, min_ev, split, budget)
+        PROGRESS.update()
+    col = np.empty(np.max(sidx)+1, dtype=int)  #sample number -> column of PLs
+    col[sidx] = np.arange(len(sidx))
+    seed = np.random.randint(2**31-len(todo))
+    with SharedArray(PLs) as shared:
+        jobs = [(node, len(node_sidx), pool.apply_async(ProfiledTask(partition_subtree), (shared, col[node_sidx], node_sidx, min_ev, split, seed+k, budget)))
+                for k,(node,node_PLs,node_sidx) in enumerate(todo)]
+        for node,m,job in jobs:
+            subtree,stages = job.get()
+            PROFILE.merge(stages)
+            for child in subtree.get_children():
+                node.add_child(child.detach())
+            PROGRESS.update(m-1)
+    PROGRESS.finish()
+
+
+@profiled('partition_subtree')
+def partition_subtree(PLs, cols, sidx, min_ev, split, seed, budget=None):
+    """partition() of one group of samples in a worker process, returns the subtree
+
+    Args:
+        PLs (SharedArray): PLs of all samples given to partition_parallel()
+        cols (np.array): columns of PLs of the samples of this group
+        sidx (np.array): sample numbers of this group
+        seed (int): seed of np.random for the random candidate splits of this group
+    """
+    PROGRESS.configure(quiet=True)  # the parent reports the progress of its workers
+    np.random.seed(seed)
+    Tree = lazy_tree()
+    PLs = attach(PLs)[:,cols]
+    tree = Tree()
+    for child,child_PLs,child_sidx in split_node(PLs, tree, sidx, min_ev, split, budget):
+        partition(child_PLs, child, child_sidx, min_ev, split, budget)
+    return tree
+
+
+def calc_minimum_pt_cost(PLs, smat, min_ev, batch=2**22, budget=None):
+    """best selection vector of smat under partition_cost
+
+    Vectors are taken from smat in blocks; the group 1 sums of a block are one
+    (vectors x samples) . (samples x sites x gtype) product, group 0 is the total minus group 1
+
+    Args:
+        PLs (np.array): phred scaled likelihoods, dim = n_site x m x g
+        smat (iterable): selection vectors (0/1 group for each sample), e.g. make_selection_matrix2
+        min_ev (int): minimum evidence in Phred scale
+        batch (int): bound on the number of PLs (vectors x sites x g) held at once
+        budget (SearchBudget): stop after the block during which it expires
+
+    Returns:
+        np.array (byte): first best selection vector (of those scored)
+        float: its cost
+    """
     n,m,g = PLs.shape
+    X = PLs.astype(np.float64) # integer PLs, sums are exact
+    total = X.sum(axis=1)
+    b = max(batch//(n*g), 1)
+    smat = iter(smat)
     pt_cost = np.inf
-    for k in smat:
-        x0 = PLs[:,k==0,].sum(axis=1) # dim = n_site x 2
-        x0min = x0.min(axis=1) # dim = n_site x 1
-        x0max = x0.max(axis=1) # dim = n_site x 1
-        x1 = PLs[:,k==1,].sum(axis=1) # dim = n_site x 2
-        x1min = x1.min(axis=1) # dim = n_site x 1
-        x1max = x1.max(axis=1) # dim = n_site x 1
-        # take everything
-        #c = (x0 + x1).sum()
-        # cap the penalty by mu
-        #c = (x0>mu).sum()*mu + x0[x0<=mu].sum() + (x1>mu).sum()*mu + x1[x1<=mu].sum()
-        # ignore sites where signal from either partitions is weak
-        #c = (x0min+x1min)[(x0max>min_ev) & (x1max>min_ev)].sum()
-        # ignore sites where signals from both partitions are weak
-        c = (x0min+x1min)[(x0max>min_ev) | (x1max>min_ev)].sum()
-        # some weird cost function that broadly penalize partition of similar samples
-        #k0 = x0.argmin(axis=1)
-        #k1 = x1.argmin(axis=1)
-        #c = np.minimum(x0[k0],x1[k1]).sum() + (k0==k1).sum()*mu
-        if c < pt_cost:
-            pt_cost = c
-            pt = k
+    while True:
+        K = np.array(list(itertools.islice(smat, b)))
+        if len(K) == 0:
+            break
+        x1 = np.tensordot(K.astype(np.float64), X, axes=([1],[1])) # dim = vectors x n_site x g
+        c = partition_cost(total - x1, x1, min_ev)
+        k = c.argmin()
+        if c[k] < pt_cost:
+            pt_cost = c[k]
+            pt = K[k]
+        PROGRESS.update(len(K), best=pt_cost)
+        if budget is not None and budget.expired():
+            break
+    return pt, pt_cost
+
+
+def partition_cost(x0, x1, min_ev):
+    """cost of splitting samples into two groups
+
+    Args:
+        x0, x1 (np.array): PLs summed over the samples of each group, dim = n_site x g
+            (or any number of partitions x n_site x g)
+        min_ev (int): minimum evidence in Phred scale
+
+    Returns:
+        float: sum over sites of the best genotype PL of each group (one per partition)
+    """
+    #elementwise over the few genotypes is faster than reducing the short last axis
+    x0min = reduce(np.minimum, np.rollaxis(x0, -1)) # dim = n_site x 1
+    x0max = reduce(np.maximum, np.rollaxis(x0, -1)) # dim = n_site x 1
+    x1min = reduce(np.minimum, np.rollaxis(x1, -1)) # dim = n_site x 1
+    x1max = reduce(np.maximum, np.rollaxis(x1, -1)) # dim = n_site x 1
+    # take everything
+    #c = (x0 + x1).sum()
+    # cap the penalty by mu
+    #c = (x0>mu).sum()*mu + x0[x0<=mu].sum() + (x1>mu).sum()*mu + x1[x1<=mu].sum()
+    # ignore sites where signal from either partitions is weak
+    #c = (x0min+x1min)[(x0max>min_ev) & (x1max>min_ev)].sum()
+    # ignore sites where signals from both partitions are weak
+    c = np.where((x0max>min_ev) | (x1max>min_ev), x0min+x1min, 0).sum(axis=-1)
+    # some weird cost function that broadly penalize partition of similar samples
+    #k0 = x0.argmin(axis=1)
+    #k1 = x1.argmin(axis=1)
+    #c = np.minimum(x0[k0],x1[k1]).sum() + (k0==k1).sum()*mu
+    return c
+
+
+def calc_minimum_pt_cost_gray(PLs, min_ev, batch=2**20, budget=None):
+    """Same as calc_minimum_pt_cost over all selection vectors of make_selection_matrix2(m) (m <= 20)
+
+    Vectors are visited in Gray-code order, so each differs from the previous one by one
+    sample and the group sums are updated by moving one sample's PLs, O(sites) per vector
+    instead of O(sites x samples). Consecutive vectors are handled together, their group
+    sums are a cumulative sum of the moves (group 0 is the total minus group 1). Ties go to
+    the vector make_selection_matrix2 yields first.
+
+    Args:
+        batch (int): bound on the number of PLs (vectors x sites x g) held at once
+        budget (SearchBudget): stop after the batch during which it expires
+
+    Returns:
+        np.array (byte): group (0/1) of each sample
+        float: cost of the partition
+    """
+    n,m,g = PLs.shape
+    PLs = np.ascontiguousarray(PLs.transpose(1,0,2), dtype=np.float64) # sample x site x gtype; integer PLs, sums are exact
+    total = PLs.sum(axis=0)
+    x1 = np.zeros_like(total) # all samples in group 0
+    pt_code = 0
+    pt_cost = partition_cost(total, x1, min_ev)
+    PROGRESS.update(best=pt_cost)
+    b = max(batch//(n*g), 1)
+    for i in xrange(1, 2**(m-1), b):
+        steps = np.arange(i, min(i+b, 2**(m-1)))
+        codes = steps ^ (steps >> 1) # Gray codes
+        bits = np.log2(steps & -steps).astype(int) # bit that changes from the previous code
+        to1 = (codes >> bits) & 1 # sample moved to group 1 (or back to 0)
+        moved = PLs[m-1-bits] * (2*to1-1)[:,None,None] # first sample is the highest bit
+        moved[0] += x1
+        x1s = np.cumsum(moved, axis=0)
+        c = partition_cost(total - x1s, x1s, min_ev)
+        k = np.flatnonzero(c == c.min())
+        k = k[codes[k].argmin()]
+        if c[k] < pt_cost or (c[k] == pt_cost and codes[k] < pt_code):
+            pt_cost = c[k]
+            pt_code = codes[k]
+        x1 = x1s[-1]
+        PROGRESS.update(len(steps), best=pt_cost)
+        if budget is not None and budget.expired():
+            break
+    pt = np.array(tuple(bin(pt_code)[2:].zfill(m)), dtype=np.byte)
+    return pt, pt_cost
+
+
+def calc_minimum_pt_cost_spectral(PLs, min_ev, batch=2**22, budget=None):
+    """Heuristic for calc_minimum_pt_cost when there are too many samples to enumerate
+
+    1. samples are ordered by the Fiedler vector of their similarity graph (expected number
+       of sites where two samples have the same genotype, as in make_D) and the best split
+       point of that order under partition_cost is taken
+    2. Kernighan-Lin style refinement: the single sample move that lowers the cost most is
+       made, until no move lowers it
+
+    Args:
+        batch (int): bound on the number of PLs (moves x sites x g) held at once
+        budget (SearchBudget): stop the refinement once it has expired
+
+    Returns:
+        np.array (byte): group (0/1) of each sample, first sample in group 0
+        float: cost of the partition
+    """
+    n,m,g = PLs.shape
+    X = np.ascontiguousarray(PLs.transpose(1,0,2), dtype=np.float64) # sample x site x gtype
+    total = X.sum(axis=0)
+
+    p = phred2p(X)
+    p /= p.sum(axis=2)[...,None]
+    S = np.tensordot(p, p, axes=([1,2],[1,2]))
+    np.fill_diagonal(S, 0.0)
+    deg = S.sum(axis=1)
+    deg[deg <= 0] = 1.0
+    d = 1.0/np.sqrt(deg)
+    w,v = np.linalg.eigh(S*d[:,None]*d) # normalized graph, 2nd largest eigenvalue is the Fiedler vector
+    order = np.argsort(v[:,-2]*d, kind='mergesort')
+
+    x1s = np.cumsum(X[order[:-1]], axis=0) # first k+1 samples of the order in group 1
+    c = partition_cost(total - x1s, x1s, min_ev)
+    k = c.argmin()
+    pt = np.zeros(m, dtype=np.byte)
+    pt[order[:(k+1)]] = 1
+    pt_cost = c[k]
+    x1 = x1s[k]
+    PROGRESS.update(m-1, best=pt_cost)
+
+    b = max(batch//(n*g), 1)
+    while True:
+        n1 = pt.sum()
+        best, j = pt_cost, -1
+        for i in xrange(0, m, b):
+            x1m = x1 + X[i:(i+b)]*(1-2*pt[i:(i+b)])[:,None,None] # move each sample to the other group
+            c = partition_cost(total - x1m, x1m, min_ev)
+            c[(pt[i:(i+b)] == 1) & (n1 == 1)] = np.inf # keep both groups non-empty
+            c[(pt[i:(i+b)] == 0) & (n1 == m-1)] = np.inf
+            k = c.argmin()
+            if c[k] < best:
+                best, j = c[k], i+k
+            PROGRESS.update(len(c), best=best)
+        if j < 0:
+            break
+        x1 = x1 + X[j]*(1-2*pt[j])
+        pt[j] = 1-pt[j]
+        pt_cost = best
+        if budget is not None and budget.expired():
+            break
+
+    if pt[0] == 1:
+        pt = 1-pt
     return pt, pt_cost
 
 
@@ -425,14 +952,23 @@ def reroot(tree, PLs, mm0, mm1, base_prior,DELTA):
     return best_tree,best_PL,flag
 
 
-def recursive_reroot(tree, PLs,mm0, mm1, base_prior,DELTA):
+@profiled('reroot_sweep')
+def recursive_reroot(tree, PLs,mm0, mm1, base_prior,DELTA,budget=None):
     """
     starting at tips, work up tree, get best way of rooting subtree 
+
+    stops early (keeping the best tree so far) once budget (SearchBudget) has expired
     """
 
-    print('recursive_reroot() begin', file=sys.stderr)
     PL = score(tree, base_prior)
+    PROGRESS.start('recursive_reroot', 'trees', 2*len(tree)-2)
+    rerooted = 0
     for node in tree.iter_descendants('postorder'):  #go through all nodes including tips but not root
+        if budget is not None:
+            if budget.expired():
+                break
+            budget.count()
+        PROGRESS.update(best=PL)
         rerooted = 0
         new_tree = tree.copy()
         node_leaves = node.get_leaf_names()
@@ -472,9 +1008,7 @@ def recursive_reroot(tree, PLs,mm0, mm1, base_prior,DELTA):
         #print(tree)
         #print(PL)
         
-    print(' done', end='', file=sys.stderr)
-    print(tree)
-    print(PL)
+    PROGRESS.finish(best=PL)
     return tree,PL,rerooted
 
 
@@ -568,7 +1102,7 @@ def nearest_neighbor_interchange(node, PLs,mm0, mm1, base_prior,DELTA):
         return possible_rearrangements
 
 
-def recursive_NNI(tree, PLs, mm0, mm1, base_prior,DELTA):
+def recursive_NNI(tree, PLs, mm0, mm1, base_prior,DELTA,budget=None):
     #recursive just means traverse the tree 
     """
     
@@ -577,6 +1111,7 @@ def recursive_NNI(tree, PLs, mm0, mm1, base_prior,DELTA):
         mm0: mutation matrix (np array of float) (non-diagonal set to 0)
         mm1: mutation matrix (np array of float) (diagonal set to 0)
         base_prior (np.array): Base prior probs depending on het pl
+        budget (SearchBudget): stop early, keeping the best tree so far, once expired
 
     Returns:
         Tree (tree)
@@ -585,8 +1120,8 @@ def recursive_NNI(tree, PLs, mm0, mm1, base_prior,DELTA):
     tree resulting from each round of nni (working from tips to root) printed to trees_tried.txt
     
     """
-    print('recursive_NNI() begin', end=' ', file=sys.stderr)
     PL = score(tree, base_prior)
+    PROGRESS.start('recursive_NNI', 'trees')
     #goes until can get through tree w/o nni at any node
     #a la phylip
     num_nnis=1
@@ -594,14 +1129,13 @@ def recursive_NNI(tree, PLs, mm0, mm1, base_prior,DELTA):
     #print(PL)
     while(num_nnis>0):
         num_nnis=0
-        print('Start nni round')
+        t_round = PROFILE.clock()
 #        for node in tree.traverse('postorder'):
 #            print(node)
         for node in tree.traverse('postorder'):
             #goes through each node, does nni if better
             if node.is_leaf():
                 continue
-            print('.', end='', file=sys.stderr)
             #print(node)
             possible_rearrangements = nearest_neighbor_interchange(node.copy(),PLs, mm0, mm1, base_prior,DELTA)
 #            print('Original original tree:')
@@ -613,6 +1147,10 @@ def recursive_NNI(tree, PLs, mm0, mm1, base_prior,DELTA):
                     for r in possible_rearrangements:
                         #print('Rearranged node:')
                         #print(r)
+                        if budget is not None:
+                            if budget.expired():
+                                break
+                            budget.count()
                         
                         new_tree = init_tree(r.copy())  #tree has nid's (node id) and sid's (list of tip names - sorted)
                         new_tree = populate_tree_PL(new_tree, PLs, mm0, 'PL0')  #tree has PLs for no mutation at tips and nodes
@@ -630,6 +1168,7 @@ def recursive_NNI(tree, PLs, mm0, mm1, base_prior,DELTA):
                             #print(best_tree)
                             PL = PL_new
                             num_nnis = 1
+                        PROGRESS.update(best=PL)
                     if num_nnis == 1:  #there was a better tree
                         tree = best_tree.copy()
                         #print('Best tree so far:')
@@ -643,6 +1182,10 @@ def recursive_NNI(tree, PLs, mm0, mm1, base_prior,DELTA):
                     for r in possible_rearrangements:
                         #print('Rearranged node:')
                         #print(r)
+                        if budget is not None:
+                            if budget.expired():
+                                break
+                            budget.count()
                         new_tree = tree.copy()
                         node_leaves = node.get_leaf_names()
                         new_node = new_tree.get_common_ancestor(node_leaves)  #get corresponding node in new tree
@@ -667,6 +1210,7 @@ def recursive_NNI(tree, PLs, mm0, mm1, base_prior,DELTA):
                             PL = PL_new
                             num_nnis = 1
                             best_tree = new_tree.copy()
+                        PROGRESS.update(best=PL)
 #                        print('Original tree:')
 #                        print(tree)
 
@@ -679,11 +1223,14 @@ def recursive_NNI(tree, PLs, mm0, mm1, base_prior,DELTA):
                         #print('No change to tree:')
                         #print(tree)
                         #print(PL)
+
+            if budget is not None and budget.expired():
+                num_nnis = 0  #keep best tree so far
+                break
+        PROFILE.add('nni_round', t_round)
                     
         #print(str(num_nnis)+' nnis', end='', file=sys.stderr)
         #print(PL)
         
-    print(' done', file=sys.stderr)
-    print(tree)
-    print(PL)
-    return tree,PL_new
\ No newline at end of file
+    PROGRESS.finish(best=PL)
+    return tree,PL
\ No newline at end of file
@@ -10,18 +10,17 @@ import signal
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 import sys
+import gzip
 import itertools
+from collections import Counter
+import multiprocessing
 import numpy as np
-from scipy.stats import sem
 #from editdistance import eval as strdist
-import vcf
-
-with warnings.catch_warnings(ImportWarning):
-    from ete2 import Tree
 
 warnings.filterwarnings('error')
 
-from tree_est import *
+# pyvcf, ete2's Tree (lazy_tree, without the rest of ete2 and scipy) and tree_est are imported
+# by the sub-commands that need them, so the others start quickly
 from utils import *
 from geno import *
 
@@ -30,62 +29,174 @@ def compat_main(args):
 
     Args:
         args.vcf (str): input vcf/vcf.gz file or - stdin
-        args.output (str): file to output compatibility matrix
+        args.output (str): basename of the compatibility matrix output
         args.min_ev (int): minimum evidence in Phred scale for a site to be considered, default 60
+        args.processes (int): number of processes computing tiles of the matrix, default 1
+        args.text (bool): also export the matrix as gzipped tab-delimited text
 
     Output to file:
-        np.array: compatibility matrix
+        <output>.npy: compatibility matrix (int32, numpy format, open with np.load(..., mmap_mode='r'))
+        <output>.gz: same as text if args.text
 
     """
     vcffile, variants, DPRs, PLs = read_vcf(args.vcf, args.min_ev)
-    #n_site, n_smpl = PLs.shape[0:2]
-    #sidx = np.arange(n_smpl)
+    n_site = PLs.shape[0]
+
+    compats = np.lib.format.open_memmap(args.output + '.npy', mode='w+', dtype=np.int32, shape=(n_site,n_site))
+    pool = multiprocessing.Pool(args.processes) if args.processes > 1 else None
+    try:
+        calc_compat(PLs, out=compats, pool=pool) #matrix of num_var x num_var containing 0 for compatible sites (ie same pattern) or 1 if not
+    finally:
+        if pool is not None:
+            pool.terminate()
+    compats.flush()
 
-    compats = calc_compat(PLs) #matrix of num_var x num_var containing 0 for compatible sites (ie same pattern) or 1 if not
-    c = compats.sum(axis=-1)  #not used?
-    k = (c == 0) & ~find_singleton(PLs)  #not used?
+    if args.text:
+        export_compat_text(compats, args.output + '.gz')
 
-    gzout = args.output + '.gz'
-    np.savetxt(gzout, compats, fmt='%d', delimiter='\t')
+
+@profiled('export_compat_text')
+def export_compat_text(compats, filename, block=1000):
+    """write a compatibility matrix as tab-delimited text, a block of rows at a time
+
+    Args:
+        compats (np.array): matrix from calc_compat(), may be a memmap
+        filename (str): output file, gzipped if it ends with .gz
+    """
+    with (gzip.open(filename, 'wb') if filename.endswith('.gz') else open(filename, 'w')) as f:
+        for i in xrange(0, len(compats), block):
+            np.savetxt(f, compats[i:(i+block)], fmt='%d', delimiter='\t')
 
 
-def calc_compat(PLs):
+@profiled('calc_compat')
+def calc_compat(PLs, block=None, out=None, pool=None):
     """Create a pairwise compatibility matrix (numpy array) for variants
     
     0 if sites are compatible, 1 if not
 
     Args:
         PLs (np.array (int)): List of Phred-scaled genotype likelihoods for each of the 2 most common alleles for each variant
+        block (int): number of sites per side of the tiles computed at once, default keeps a tile
+            around 2M words (block x block x num samples/64)
+        out (np.array): n x n int32 array (e.g. a memmap) to fill instead of a new one
+        pool (multiprocessing.Pool): compute the tiles in these processes
 
     Returns:
         np.array: matrix of num_var x num_var containing 0 for compatible sites (ie same pattern) or 1 if not
 
     """
-    print('calc_compat() begin', end=' ', file=sys.stderr)
     n,m,g = PLs.shape       #get array dimensions - ie n=num_variants, m=num samples, g=num genotypes
-    nidx = np.arange(n)     #ints from 0 to num var
-    midx = np.arange(m)     #ints from 0 to num samples
-    kn = np.tile(nidx,m).reshape(m,n)   #repeat nidx m times
-    km = np.repeat(midx,n).reshape(m,n)
 
     PLs = PLs.astype(int)
     gt = (PLs[...,0]==0).astype(np.byte) # num var x num samples; genotype as 1 or 0 (is or not homozygous ref)
     #WHY ARE NON ZEROS ONE PL V THE OTHER????
-    non_zeros = PLs[kn,km,gt.T].T # n x m; cell is PL of homo ref if it's a het or PL of het if homo ref
-    #still not sure what below is doing to get matrix or whether it's correct
-    groups = (2*gt[i]+gt for i in xrange(n)) # each n x m
-    cost = (np.minimum(non_zeros[i], non_zeros) for i in xrange(n)) # each n x m
+    non_zeros = np.where(gt==1, PLs[...,1], PLs[...,0]) # n x m; cell is PL of homo ref if it's a het or PL of het if homo ref
+
+    bits = pack_gt(gt)
+    if block is None:
+        block = max(int(np.sqrt(2e6/bits.shape[1])), 1)
+    if out is None:
+        out = np.zeros(shape=(n,n), dtype=np.int32)  #0 array of num_var x num_var to compare each var 
+    arrays = (gt, non_zeros, bits)
+    if pool is not None:
+        arrays = tuple(SharedArray(a) for a in arrays)  #workers map them instead of getting every tile pickled
+    tasks = ((i, j, block, arrays) for i in xrange(0, n, block) for j in xrange(i, n, block))  #only need to compute half of matrix (symmetrical)
+    n_block = (n+block-1)//block
+    PROGRESS.start('calc_compat', 'tiles', n_block*(n_block+1)//2)
+    if pool is not None:
+        tiles = pool.imap(ProfiledTask(compat_tile_task), tasks)
+    else:
+        tiles = ((tile, None) for tile in itertools.imap(compat_tile_task, tasks))
+    try:
+        for (i,j,tile),stages in tiles:
+            PROFILE.merge(stages)
+            if i == j:
+                tile = np.triu(tile)
+                tile = tile + tile.T - np.diag(tile.diagonal())  #make symmetrical
+            out[i:(i+block),j:(j+block)] = tile
+            out[j:(j+block),i:(i+block)] = tile.T
+            PROGRESS.update()
+    finally:
+        for a in arrays:
+            if isinstance(a, SharedArray):
+                a.close()
+
+    PROGRESS.finish()
+    return out
+
+
+@profiled('compat_tile')
+def compat_tile_task(task):
+    """compat_tile() of one task from calc_compat(), returning its position too
+
+    Args:
+        task (tuple): i, j, block and the gt, non_zeros and bits arrays (or SharedArray) of all sites
+    """
+    i,j,block,arrays = task
+    gt,non_zeros,bits = [attach(a) for a in arrays]
+    return i, j, compat_tile(gt[i:(i+block)], non_zeros[i:(i+block)], bits[i:(i+block)],
+                             gt[j:(j+block)], non_zeros[j:(j+block)], bits[j:(j+block)])
+
+
+POPCOUNT8 = np.array([bin(i).count('1') for i in xrange(256)], dtype=np.uint8)
+
+def pack_gt(gt):
+    """pack 0/1 genotype patterns into bitsets
+
+    Args:
+        gt (np.array): 0/1 genotype calls, dim = n x m
+
+    Returns:
+        np.array (uint64): one row of ceil(m/64) words per site
+    """
+    n,m = gt.shape
+    w = (m+63)//64
+    packed = np.zeros((n,w*8), dtype=np.uint8)
+    packed[:,:(m+7)//8] = np.packbits(gt.astype(bool), axis=1)
+    return packed.view(np.uint64)
+
+
+def popcount(bits):
+    """number of set bits, summed over the last (word) axis"""
+    bits = np.ascontiguousarray(bits)
+    return POPCOUNT8[bits.view(np.uint8)].sum(axis=-1, dtype=np.int64)
 
-    compats = np.zeros(shape=(n,n), dtype=np.int32)  #0 array of num_var x num_var to compare each var 
-    for i in xrange(n):
-        grp = groups.next()
-        cst = cost.next()
-        compats[i,i:] = map(min, map(np.bincount, grp[i:], cst[i:]))  #only need to fill in half of matrix (symmetrical)
-        #
-    compats = compats + compats.T - np.diag(compats.diagonal())  #make symmetrical
 
-    print(' done', file=sys.stderr)
-    return compats
+def compat_tile(gt0, non_zeros0, bits0, gt1, non_zeros1, bits1):
+    """compatibility of every site of one block with every site of another
+
+    For sites i (rows) and j (columns) each sample falls in group 2*gt[i]+gt[j] at a cost of
+    min(non_zeros[i], non_zeros[j]); the compatibility is the smallest group cost among
+    groups 0 up to the largest group present (groups missing below it cost 0). Group sizes
+    come from the bitsets, so PL costs are only summed for pairs with no such missing group.
+
+    Args:
+        gt0, non_zeros0 (np.array): called genotypes and their PLs for the row sites, dim = block x m
+        bits0 (np.array): gt0 packed by pack_gt()
+        gt1, non_zeros1, bits1: same for the column sites
+
+    Returns:
+        np.array (int): dim = rows x columns
+    """
+    m = gt0.shape[1]
+    n3 = popcount(bits0[:,None,:] & bits1[None,:,:]) # number of samples in each group
+    n2 = popcount(bits0)[:,None] - n3
+    n1 = popcount(bits1)[None,:] - n3
+    n0 = m - n1 - n2 - n3
+    top = np.where(n3 > 0, 3, np.where(n2 > 0, 2, np.where(n1 > 0, 1, 0))) # largest group present
+    need = (n0 > 0) & ((n1 > 0) | (top < 1)) & ((n2 > 0) | (top < 2))
+
+    tile = np.zeros(n3.shape, dtype=np.int64)
+    ii,jj = np.nonzero(need)
+    chunk = max(int(4e6//max(m,1)), 1)
+    for k in xrange(0, len(ii), chunk):
+        i,j = ii[k:(k+chunk)], jj[k:(k+chunk)]
+        grp = 2*gt0[i]+gt1[j]
+        cst = np.minimum(non_zeros0[i], non_zeros1[j])
+        w = np.array([np.where(grp==c, cst, 0).sum(axis=1) for c in xrange(4)])
+        w[np.arange(4)[:,None] > top[i,j]] = np.iinfo(w.dtype).max
+        tile[i,j] = w.min(axis=0)
+    return tile
 
 
 def find_singleton(PLs):
@@ -105,6 +216,7 @@ def split_main(args):
 
 # TODO
 def rsplit_main(args):
+    Tree = lazy_tree()
     print(args, file=sys.stderr)
     vcffile, variants, DPRs, PLs = read_vcf(args.vcf, args.min_ev)
     n,m,g = PLs.shape
@@ -120,6 +232,7 @@ def rsplit_main(args):
 
 # TODO
 def subdiv(PLs, tree):
+    Tree = lazy_tree()
     n,m,g = PLs.shape
     tree.sid = range(m)
     for i in xrange(n):
@@ -151,20 +264,47 @@ def tview_main(args):
         args.tree (str): string containing newick to be converted to Tree
         args.attrs (str): node attributes given by a comma separated list
         args.label (str): leaves label
+        args.multi (bool): args.tree is a file (or - for stdin) of trees, one per line
         
-    Prints tree
+    Prints tree (each preceded by <file>:<line> if args.multi)
 
     """
-    tree = Tree(args.tree)
-    if args.attrs:
-        attrs = args.attrs.split(',')
-        if 'label' in attrs and args.label:
-            label = read_label(args.label)
-            for leaf in tree.iter_leaves():
-                leaf.add_feature('label', label.get(leaf.name))
-        print(tree.get_ascii(attributes=attrs, show_internal=False))
-    else:
-        print(tree)
+    Tree = lazy_tree()
+    attrs = args.attrs.split(',') if args.attrs else None
+    label = read_label(args.label) if attrs and 'label' in attrs and args.label else None
+    trees = read_newick_stream(args.tree) if args.multi else [(None, args.tree)]
+    for name,nwk in trees:
+        tree = Tree(nwk)
+        if name is not None:
+            print(name)
+        if attrs:
+            if label is not None:
+                for leaf in tree.iter_leaves():
+                    leaf.add_feature('label', label.get(leaf.name))
+            print(tree.get_ascii(attributes=attrs, show_internal=False))
+        else:
+            print(tree)
+
+
+def read_newick_stream(filename):
+    """Newick trees in a file, one per line, read lazily
+
+    Args:
+        filename (str): input file, - for stdin
+
+    Yields:
+        str: <file>:<line> to name the tree
+        str: the tree in Newick format
+    """
+    f = sys.stdin if filename == '-' else open(filename)
+    try:
+        for i,line in enumerate(f, 1):
+            line = line.strip()
+            if line:
+                yield '%s:%d' % (filename, i), line
+    finally:
+        if f is not sys.stdin:
+            f.close()
 
 
 def read_label(filename):
@@ -186,27 +326,73 @@ def read_label(filename):
 
 
 def annotate_main(args):
+    Tree = lazy_tree()
     print(args, file=sys.stderr)
 
     tree = Tree(args.tree)
     tree = init_tree(tree)
 
-    gtcall = read_gtcall(args.gtcall)
-    for node in tree.iter_descendants('postorder'):
-        k = gtcall['mut_smpl'] == ','.join(map(str,node.sid))
-        node.dist = k.sum()+1
+    n_mut = Counter()  #number of calls for each set of mutated samples
+    with PROFILE.stage('read_gtcall'):
+        for gtcall in iter_gtcall(args.gtcall):
+            n_mut.update(gtcall['mut_smpl'].tolist())
+    annotate_tree(tree, n_mut)
     tree.write(outfile=args.output, format=5)
 
 
+def annotate_tree(tree, n_mut):
+    """set the length of each branch to 1 + the number of calls mutating the samples below it
+
+    Args:
+        tree (Tree): lineage tree with sid (see init_tree)
+        n_mut (Counter): number of gtype calls for each mut_smpl
+    """
+    for node in tree.iter_descendants('postorder'):
+        node.dist = n_mut[','.join(map(str,node.sid))]+1
+    return tree
+
+
 def read_gtcall(filename):
-    dtype=[('chrom','a10'),('pos','i4'),('ref','a1'),
-           ('null_p','f8'),('mut_p','f8'),
-           ('null_base','a2'),('null_base_p','f8'),
-           ('mut_base','a2'),('mut_alt','a2'),('mut_conf_p','f8'),
-           ('mut_loc','i4'),('mut_smpl','a128')]
-    if filename == '-':
-        filename = sys.stdin
-    return np.loadtxt(filename, dtype=dtype)
+    """all gtype calls in a file, see iter_gtcall()"""
+    chunks = list(iter_gtcall(filename))
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=GTCALL_DTYPE)
+
+
+def iter_gtcall(filename, chunk=100000):
+    """gtype calls a chunk at a time
+
+    Args:
+        filename (str): tab-delimited calls written by gtype, "-" for stdin
+        chunk (int): number of calls in each chunk
+
+    Yields:
+        np.array: GTCALL_DTYPE
+    """
+    f = sys.stdin if filename == '-' else open(filename)
+    try:
+        rows = []
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            rows.append(tuple(line.rstrip('\n').split('\t')))
+            if len(rows) == chunk:
+                yield np.array(rows, dtype=GTCALL_DTYPE)
+                rows = []
+        if rows:
+            yield np.array(rows, dtype=GTCALL_DTYPE)
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def neighbor_main(args):
+    """nbjoin, see tree_est.neighbor_main"""
+    lazy_import('tree_est').neighbor_main(args)
+
+
+def pipeline_main(args):
+    """nbjoin, gtype and annot in one process, see pipeline.run_pipeline"""
+    lazy_import('pipeline').pipeline_main(args)
+
 
 def compare_main(args):
     	
@@ -215,9 +401,11 @@ def compare_main(args):
     Args:
         args.tree (str): input tree(s), in Newick format
         args.ref (str): reference tree, in Newick format
+        args.processes (int): number of processes comparing trees, default 1
+        args.multi (bool): each of args.tree is a file (or - for stdin) of trees, one per line
         
     Prints:
-        tree
+        tree (<file>:<line> if args.multi)
         result['norm_rf']: normalized robinson-foulds distance (from 0 to 1)
         result['ref_edges_in_source']: compatibility score of the target tree with respect to the source tree (how many edges in reference are found in the source)
         result['source_edges_in_ref']: compatibility score of the source tree with respect to the reference tree (how many edges in source are found in the reference)
@@ -227,33 +415,164 @@ def compare_main(args):
     """
     
     print(args, file=sys.stderr)
-    ref_tree = Tree(args.ref)
+    if args.multi:
+        trees = itertools.chain.from_iterable(itertools.imap(read_newick_stream, args.tree))
+    else:
+        trees = ((f, f) for f in args.tree)
+    if args.processes > 1:
+        pool = multiprocessing.Pool(args.processes, initializer=init_compare, initargs=(args.ref,))
+        rows = pool.imap(ProfiledTask(compare_tree), trees)  #results come back in input order
+    else:
+        pool = None
+        init_compare(args.ref)
+        rows = ((row, None) for row in itertools.imap(compare_tree, trees))
+    PROGRESS.start('compare', 'trees')
+    try:
+        for row,stages in rows:
+            PROFILE.merge(stages)
+            if row is not None:
+                print(row)
+            PROGRESS.update()
+        PROGRESS.finish()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+COMPARE_REF = {}
+
+def init_compare(ref):
+    """parse the reference tree for compare_tree(), once per process
+
+    Args:
+        ref (str): reference tree, in Newick format
+    """
+    Tree = lazy_tree()
+    ref_tree = Tree(ref)
     ref_tree_leafnames = [l.name for l in ref_tree.get_leaves()]
     leaf_idx = {l:i for i,l in enumerate(ref_tree_leafnames)}  #how to get int for leaf name consistent btwn trees
-    
-    ref_am = tree2adjacency(ref_tree,leaf_idx)   #matrix of "distances" for ref (node counts)
-    for f in args.tree:
-        tree = Tree(f)
-        tree_leafnames = [l.name for l in tree.get_leaves()]
-        if set(tree_leafnames) != set(ref_tree_leafnames):
-            print('leaf names are not the same', file=sys.stderr)
-        am = tree2adjacency(tree,leaf_idx)   #matrix of "distances" for comparison
-        if ref_am.shape != am.shape:
-            print('%s incompatible with %s' % (f, args.ref), file=sys.stderr)
+    leaf_bit = split_bits(ref_tree_leafnames)
+    COMPARE_REF.update(name=ref, tree=ref_tree, leafnames=set(ref_tree_leafnames), leaf_idx=leaf_idx,
+                       am=tree2adjacency(ref_tree,leaf_idx),   #matrix of "distances" for ref (node counts)
+                       leaf_bit=leaf_bit, splits=tree_splits(ref_tree, leaf_bit))
+
+
+@profiled('compare_tree')
+def compare_tree(item):
+    """compare one tree with the reference set by init_compare()
+
+    Args:
+        item (tuple): name of the tree and the tree (or its file), in Newick format
+
+    Returns:
+        str: <tree>,<norm_rf>,<ref_edge_in_tree>,<tree_edge_in_ref>,<diff_adj>,<ratio_adj>, tab-delimited,
+            on the leaves the trees share if their leaves differ (both are pruned to these),
+            None if they share fewer than 2 leaves
+    """
+    Tree = lazy_tree()
+    ref = COMPARE_REF
+    f,nwk = item
+    tree = Tree(nwk)
+    tree_leafnames = set(l.name for l in tree.get_leaves())
+    if tree_leafnames == ref['leafnames']:
+        leaf_idx,ref_am = ref['leaf_idx'],ref['am']
+        leaf_bit,ref_splits = ref['leaf_bit'],ref['splits']
+    else:
+        shared = tree_leafnames & ref['leafnames']
+        if len(shared) < 2:
+            print('%s incompatible with %s' % (f, ref['name']), file=sys.stderr)
+            return None
+        print('%s: leaf names are not the same as in %s, compared on the %d shared leaves' % (f, ref['name'], len(shared)), file=sys.stderr)
+        tree.prune(list(shared))
+        ref_tree = ref['tree'].copy()
+        ref_tree.prune(list(shared))
+        leaf_idx = {l:i for i,l in enumerate(sorted(shared))}
+        ref_am = tree2adjacency(ref_tree,leaf_idx)
+        leaf_bit = split_bits(shared)
+        ref_splits = tree_splits(ref_tree, leaf_bit)
+    am = tree2adjacency(tree,leaf_idx)   #matrix of "distances" for comparison
+    if ref_am.shape != am.shape:  #e.g. repeated leaf names
+        print('%s incompatible with %s' % (f, ref['name']), file=sys.stderr)
+        return None
+    k = ref_am > 0
+
+    diff = np.abs(ref_am - am)
+    dstat = diff[k].sum()/k.sum()
+
+    ratio = am[k]/ref_am[k]
+    ratio[ratio>1] = 1.0/ratio[ratio>1]
+    rstat = np.power(ratio.prod(), 1.0/k.sum())
+
+    norm_rf,tree_in_ref,ref_in_tree = compare_splits(tree_splits(tree, leaf_bit), ref_splits, len(leaf_bit))
+
+    return '%s\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f' % (f, norm_rf, tree_in_ref, ref_in_tree, dstat, rstat)
+
+
+def split_bits(leafnames):
+    """dict of
+        key: leaf name
+        value: its bit in a split, the first name in sorted order gets the lowest bit
+    """
+    return {l:1<<i for i,l in enumerate(sorted(leafnames))}
+
+
+def tree_splits(tree, leaf_bit):
+    """bipartitions of a tree, taken as unrooted, in one postorder pass
+
+    Each node splits the leaves in leaf_bit (others are ignored) into those below it and the rest;
+    a split is stored as the bitset of the side without the lowest bit
+
+    Args:
+        tree (Tree)
+        leaf_bit (dict): from split_bits()
+
+    Returns:
+        set (int): splits
+    """
+    full = (1<<len(leaf_bit)) - 1
+    below = {}
+    splits = set()
+    for node in tree.traverse('postorder'):
+        if node.is_leaf():
+            b = leaf_bit.get(node.name, 0)
         else:
-            k = ref_am > 0
+            b = 0
+            for c in node.children:
+                b |= below.pop(c)
+        below[node] = b
+        splits.add(full ^ b if b & 1 else b)
+    return splits
 
-            diff = np.abs(ref_am - am)
-            dstat = diff[k].sum()/k.sum()
 
-            ratio = am[k]/ref_am[k]
-            ratio[ratio>1] = 1.0/ratio[ratio>1]
-            rstat = np.power(ratio.prod(), 1.0/k.sum())
+def compare_splits(splits, ref_splits, n_leaf):
+    """robinson-foulds distance and shared edges of two trees, as in ete2 compare(unrooted=True)
 
-            result = ref_tree.compare(tree, unrooted=True)  #comparison calculated by ete2
+    Args:
+        splits, ref_splits (set): from tree_splits() with the same leaf_bit
+        n_leaf (int): number of leaves in leaf_bit
 
-            # <tree>,<norm_rf>,<ref_edge_in_tree>,<tree_edge_in_ref>,<diff_adj>,<ratio_adj>
-            print('%s\t%.3f\t%.3f\t%.3f\t%.3f\t%.3f' % (f, result['norm_rf'], result['ref_edges_in_source'], result['source_edges_in_ref'], dstat, rstat))
+    Returns:
+        float: normalized robinson-foulds distance, -1 if there are no informative splits
+        float: fraction of valid edges in splits found in ref_splits, -1 if none
+        float: fraction of valid edges in ref_splits found in splits, -1 if none
+    """
+    def size(b):
+        return bin(b).count('1')
+    def informative(s):
+        return set(b for b in s if 1 < size(b) < n_leaf-1)
+    def valid(s):  #the side with the first leaf name needs more than one leaf
+        return set(b for b in s if 0 < size(b) < n_leaf-1)
+
+    rf = len(splits ^ ref_splits)
+    max_rf = len(informative(splits)) + len(informative(ref_splits))
+    if max_rf > 0 and splits and ref_splits:
+        edges,ref_edges = valid(splits),valid(ref_splits)
+    else:
+        edges,ref_edges = set(),set()
+    common = len(edges & ref_edges)
+    return (rf/float(max_rf) if max_rf else -1,
+            common/float(len(edges)) if edges else -1,
+            common/float(len(ref_edges)) if ref_edges else -1)
 
 
 def tree2adjacency(tree,leaf_idx):
@@ -264,17 +583,24 @@ def tree2adjacency(tree,leaf_idx):
 
     Returns:
         np array (float): matrix of size num_leaves x num_leaves containing the number of nodes between pairs of leaves
-            num nodes comes from the get_distance function in ete2 using topology_only
+            (as the get_distance function in ete2 using topology_only), filled one common ancestor at a time
 
     """
     leaves = tree.get_leaves()
     m = len(leaves)
     adjmat = np.zeros(shape=(m,m), dtype=int)
-    for l1 in leaves:  #leaf names are not in numeric order
-        i = leaf_idx[l1.name]
-        for l2 in leaves:
-            j = leaf_idx[l2.name]
-            adjmat[i,j] = l1.get_distance(l2, topology_only=True)
+    below = {} # node: (index of leaves below it, number of edges down to each)
+    for node in tree.traverse('postorder'):  #leaf names are not in numeric order
+        if node.is_leaf():
+            below[node] = (np.array([leaf_idx[node.name]]), np.zeros(1, dtype=int))
+            continue
+        groups = [below.pop(c) for c in node.children]
+        for k,(i,di) in enumerate(groups):  #node is the common ancestor of leaves under different children
+            for j,dj in groups[(k+1):]:
+                d = di[:,None] + dj + 1
+                adjmat[np.ix_(i,j)] = d
+                adjmat[np.ix_(j,i)] = d.T
+        below[node] = (np.concatenate([i for i,di in groups]), np.concatenate([di for i,di in groups]) + 1)
     return adjmat.astype(float)
 
 
@@ -318,59 +644,94 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     subp = parser.add_subparsers(metavar='<command>', help='sub-commands')
 
-    #tview uses tview_main, read_label
-    parser_tview = subp.add_parser('tview', help='view tree')
+    #options of every sub-command
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--progress', metavar='SEC', dest='progress', type=float, default=10.0, help='report progress (rate, ETA, best score) at most every SEC seconds, default 10')
+    common.add_argument('--progress-log', metavar='FILE', dest='progress_log', type=str, help='also append progress reports to FILE as json lines')
+    common.add_argument('--quiet', dest='quiet', action='store_true', help='no progress reports on stderr')
+    common.add_argument('--profile', metavar='FILE', dest='profile', type=str, help='write the count, time and peak RSS of each stage to FILE, json if FILE ends with .json, otherwise tab-delimited')
+
+    #tview uses tview_main, read_newick_stream, read_label
+    parser_tview = subp.add_parser('tview', help='view tree', parents=[common])
     parser_tview.add_argument('tree', metavar='<nwk>', type=str, help='input tree in Newick format')
     parser_tview.add_argument('-a', metavar='STR', dest='attrs', type=str, help='node attributes to print given by a comma separated list')
     parser_tview.add_argument('-l', metavar='FILE', dest='label', type=str, help='leaves label')
+    parser_tview.add_argument('--multi', dest='multi', action='store_true', help='<nwk> is a file of trees, one per line, "-" for stdin')
     parser_tview.set_defaults(func=tview_main)
 
-    #compare uses compare_main, tree2adjacency
-    parser_compare = subp.add_parser('compare', help='compare tree topology')
+    #compare uses compare_main, read_newick_stream, init_compare, compare_tree, tree_splits, compare_splits, tree2adjacency
+    parser_compare = subp.add_parser('compare', help='compare tree topology', parents=[common])
     parser_compare.add_argument('-t', metavar='FILE', dest='tree', type=str, nargs='+', required=True, help='input tree(s), in Newick format')
     parser_compare.add_argument('-r', metavar='FILE', dest='ref', type=str, required=True, help='reference tree, in Newick format')
+    parser_compare.add_argument('-p', metavar='INT', dest='processes', type=int, default=1, help='number of processes comparing trees, default 1')
+    parser_compare.add_argument('--multi', dest='multi', action='store_true', help='each input tree file holds trees, one per line, "-" for stdin')
     parser_compare.set_defaults(func=compare_main)
 
     #compat uses compat_main, read_vcf, calc_compat, find_singleton
-    parser_compat = subp.add_parser('compat', help='calculate pairwise compatibility between all pairs of sites')
+    parser_compat = subp.add_parser('compat', help='calculate pairwise compatibility between all pairs of sites', parents=[common])
     parser_compat.add_argument('vcf', metavar='<vcf>', type=str, help='input vcf/vcf.gz file, "-" for stdin')
-    parser_compat.add_argument('output', metavar='<output>', type=str, help='output compatibility matrix')
+    parser_compat.add_argument('output', metavar='<output>', type=str, help='output basename, the matrix is written to <output>.npy')
     parser_compat.add_argument('-v', metavar='INT', dest='min_ev', type=int, default=60, help='minimum evidence in Phred scale for a site to be considered, default 60')
+    parser_compat.add_argument('-p', metavar='INT', dest='processes', type=int, default=1, help='number of processes computing the matrix, default 1')
+    parser_compat.add_argument('--text', dest='text', action='store_true', help='also export the matrix as gzipped text to <output>.gz')
     parser_compat.set_defaults(func=compat_main)
 
     #nbjoin uses neighbor_main, read_vcf, make_base_prior (normalize_PL), make_mut_matrix (phred2p, gtype_distance), make_D (pairwise_diff, normalize2d_PL, phred2p), init_star_tree, neighbor_joining
     #init_tree, populate_tree_PL, calc_mut_likelihoods (p2phred), recursive_NNI (nearest_neighbor_interchange, update_PL, score), recursive_reroot (reroot, update_PL)
-    parser_nbjoin = subp.add_parser('nbjoin', help='neighbor-joining')
+    parser_nbjoin = subp.add_parser('nbjoin', help='neighbor-joining', parents=[common])
     parser_nbjoin.add_argument('vcf', metavar='<vcf>', type=str, help='input vcf/vcf.gz file, "-" for stdin')
     parser_nbjoin.add_argument('output', metavar='output', type=str, help='output basename')
     parser_nbjoin.add_argument('-m', metavar='INT', dest='mu', type=int, default=80, help='mutation rate in Phred scale, default 80')
     parser_nbjoin.add_argument('-e', metavar='INT', dest='het', type=int, default=30, help='heterozygous rate in Phred scale, default 30')
     parser_nbjoin.add_argument('-v', metavar='INT', dest='min_ev', type=int, default=60, help='minimum evidence in Phred scale for a site to be considered, default 60')
+    parser_nbjoin.add_argument('-p', metavar='INT', dest='processes', type=int, default=1, help='number of processes building the partition starting tree, default 1')
+    parser_nbjoin.add_argument('--split', metavar='STR', dest='split', choices=('random','spectral'), default='random', help='how the partition starting tree splits more than 20 samples (more than 10 with spectral): "random" (best of 2^20 random splits) or "spectral" (spectral split refined by moving samples, for hundreds of samples), default random')
+    parser_nbjoin.add_argument('--dist', metavar='FILE', dest='dist', type=str, help='sample distance matrix saved by --save-dist from the same vcf, instead of computing it')
+    parser_nbjoin.add_argument('--save-dist', metavar='FILE', dest='save_dist', type=str, help='save the sample distance matrix to FILE for later runs with --dist')
+    parser_nbjoin.add_argument('--nj-bounded', dest='nj_bounded', action='store_true', help='RapidNJ-style bounded search for the neighbor-joining starting tree, for large numbers of samples')
+    parser_nbjoin.add_argument('--time-budget', metavar='SEC', dest='time_budget', type=float, help='stop the search after SEC seconds and keep the best tree so far, default no limit')
+    parser_nbjoin.add_argument('--max-evals', metavar='INT', dest='max_evals', type=int, help='stop the search after scoring INT candidate trees and keep the best tree so far, default no limit')
     parser_nbjoin.set_defaults(func=neighbor_main)
 
     #gtype uses genotype_main
-    parser_gtype = subp.add_parser('gtype', help='genotype samples with help of a lineage tree')
+    parser_gtype = subp.add_parser('gtype', help='genotype samples with help of a lineage tree', parents=[common])
     parser_gtype.add_argument('vcf', metavar='<vcf>', type=str, help='input vcf/vcf.gz file, "-" for stdin')
     parser_gtype.add_argument('output', metavar='<output>', type=str, help='output basename')
     parser_gtype.add_argument('-t', metavar='FILE', dest='tree', type=str, required=True, help='lineage tree')
     parser_gtype.add_argument('-n', metavar='INT', dest='nsite', type=int, default=1000, help='number of sites processed once, default 1000')
     parser_gtype.add_argument('-m', metavar='INT', dest='mu', type=int, default=80, help='mutation rate in Phred scale, default 80')
     parser_gtype.add_argument('-e', metavar='INT', dest='het', type=int, default=30, help='heterozygous rate in Phred scale, default 30, 0 for uninformative')
+    parser_gtype.add_argument('--output-type', metavar='STR', dest='output_type', choices=('text','vcf'), default='text', help='"text" for tab-delimited calls or "vcf" for the genotyped vcf records with the calls as INFO fields, default text')
     parser_gtype.set_defaults(func=genotype_main)
 
-    #annot uses annotate_main
-    parser_annot = subp.add_parser('annot', help='annotate lineage tree with genotype calls')
+    #annot uses annotate_main, iter_gtcall
+    parser_annot = subp.add_parser('annot', help='annotate lineage tree with genotype calls', parents=[common])
     parser_annot.add_argument('gtcall', metavar='<gtcall>', type=str, help='input gtype calls, "-" for stdin')
     parser_annot.add_argument('output', metavar='<outnwk>', type=str, help='output tree in Newick format')
     parser_annot.add_argument('-t', metavar='FILE', dest='tree', type=str, required=True, help='lineage tree')
     parser_annot.set_defaults(func=annotate_main)
 
-    #parser_split = subp.add_parser('split', help='a top-down method that partition samples at a sequence of variants ordered by decreasing MAF')
+    #pipeline uses pipeline_main (run_pipeline: read_vcf_data, neighbor_search, gtype_tree, genotype, annotate_tree)
+    parser_pipeline = subp.add_parser('pipeline', help='nbjoin, gtype with the best tree and annot, reading the vcf once', parents=[common])
+    parser_pipeline.add_argument('vcf', metavar='<vcf>', type=str, help='input vcf/vcf.gz file, "-" for stdin')
+    parser_pipeline.add_argument('output', metavar='<output>', type=str, help='output basename')
+    parser_pipeline.add_argument('-m', metavar='INT', dest='mu', type=int, default=80, help='mutation rate in Phred scale, default 80')
+    parser_pipeline.add_argument('-e', metavar='INT', dest='het', type=int, default=30, help='heterozygous rate in Phred scale, default 30')
+    parser_pipeline.add_argument('-v', metavar='INT', dest='min_ev', type=int, default=60, help='minimum evidence in Phred scale for a site to be considered, default 60')
+    parser_pipeline.add_argument('-n', metavar='INT', dest='nsite', type=int, default=1000, help='number of sites genotyped at once, default 1000')
+    parser_pipeline.add_argument('-p', metavar='INT', dest='processes', type=int, default=1, help='number of processes building the partition starting tree, default 1')
+    parser_pipeline.add_argument('--split', metavar='STR', dest='split', choices=('random','spectral'), default='random', help='as for nbjoin, default random')
+    parser_pipeline.add_argument('--nj-bounded', dest='nj_bounded', action='store_true', help='as for nbjoin')
+    parser_pipeline.add_argument('--time-budget', metavar='SEC', dest='time_budget', type=float, help='as for nbjoin, default no limit')
+    parser_pipeline.add_argument('--max-evals', metavar='INT', dest='max_evals', type=int, help='as for nbjoin, default no limit')
+    parser_pipeline.set_defaults(func=pipeline_main)
+
+    #parser_split = subp.add_parser('split', help='a top-down method that partition samples at a sequence of variants ordered by decreasing MAF', parents=[common])
     #parser_split.add_argument('vcf', metavar='<vcf>', type=str, help='input vcf/vcf.gz file, "-" for stdin')
     #parser_split.add_argument('output', metavar='<output>', type=str, help='output basename')
     #parser_split.set_defaults(func=split_main)
 
-    #parser_rsplit = subp.add_parser('rsplit', help='similar to "split" but involves random shuffling of variants instead of ordering by MAF')
+    #parser_rsplit = subp.add_parser('rsplit', help='similar to "split" but involves random shuffling of variants instead of ordering by MAF', parents=[common])
     #parser_rsplit.add_argument('vcf', metavar='<vcf>', type=str, help='input vcf/vcf.gz file, "-" for stdin')
     #parser_rsplit.add_argument('output', metavar='<output>', type=str, help='output basename')
     #parser_rsplit.add_argument('-n', metavar='INT', dest='n_rep', type=int, default=1000, help='number of random shuffles, default 1000')
@@ -379,6 +740,13 @@ if __name__ == '__main__':
 
     try:
         args = parser.parse_args()
-        args.func(args)
+        PROGRESS.configure(args.progress, args.quiet, args.progress_log)
+        if args.profile:
+            PROFILE.enable()
+        try:
+            args.func(args)
+        finally:
+            if args.profile:
+                PROFILE.write(args.profile)
     except KeyboardInterrupt:
         sys.exit(1)
@@ -10,19 +10,378 @@ import signal
 signal.signal(signal.SIGPIPE, signal.SIG_DFL)
 
 import sys
+import os
+import time
+import atexit
+import tempfile
+import json
+import resource
+import functools
 import itertools
+import importlib
+import imp
+import types
 import numpy as np
-from scipy.stats import sem
 #from editdistance import eval as strdist
-import vcf
-
-with warnings.catch_warnings(ImportWarning):
-    from ete2 import Tree
 
 warnings.filterwarnings('error')
 
 DELTA=0.0001  #move this so it's not global
 
+def lazy_import(name):
+    """import a module when a sub-command first needs it, e.g. ete2 (which loads scipy) is slow to import
+
+    warnings are not turned into errors while importing, as they were not when the import was at the top
+    (e.g. numpy binary compatibility warnings from scipy)
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return importlib.import_module(name)
+
+def lazy_tree():
+    """ete2's Tree class, imported from ete2.coretype.tree only
+
+    import ete2 loads all of ete2 (clustering with scipy, tree viewers, ...), which is most of the
+    startup time of the sub-commands that only read, walk and write trees. If ete2 is not imported
+    yet, an empty ete2 package with just Tree is registered to import the core from, so a later
+    lazy_import('ete2').Tree gets the same class but the rest of ete2 is not available.
+    """
+    if 'ete2' not in sys.modules:
+        path = imp.find_module('ete2')[1]
+        ete2 = types.ModuleType('ete2')
+        ete2.__path__ = [path]
+        ete2.__file__ = os.path.join(path, '__init__.py')
+        sys.modules['ete2'] = ete2
+        ete2.Tree = lazy_import('ete2.coretype.tree').Tree
+    return sys.modules['ete2'].Tree
+
+class Profile(object):
+    """Call counts, cumulative wall time and peak RSS of the stages of a run, for --profile
+
+    Stages are recorded by the profiled() decorator, by `with PROFILE.stage(name):` or by
+    PROFILE.add(name, t0) with t0 from PROFILE.clock(); all of these do nothing until enable().
+    Nested stages are each counted in full (e.g. score within nni_round). Stages run by pool
+    workers through ProfiledTask are merged in: their seconds are summed over the workers (so may
+    exceed the run's wall time) and their max_rss_kb is that of the largest worker.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}  # name -> [count, seconds, max_rss_kb]
+        self.order = []
+        self.t0 = None
+
+    def enable(self):
+        """start recording, clearing anything recorded before"""
+        self.__init__()
+        self.enabled = True
+        self.t0 = time.time()
+
+    def clock(self):
+        """start time to pass to add(), None when not recording"""
+        return time.time() if self.enabled else None
+
+    def add(self, name, t0, count=1):
+        """record count occurrences of stage name that took since t0 (from clock()) in total"""
+        if t0 is None:
+            return
+        seconds = time.time() - t0
+        if name not in self.stages:
+            self.stages[name] = [0, 0.0, 0]
+            self.order.append(name)
+        s = self.stages[name]
+        s[0] += count
+        s[1] += seconds
+        s[2] = max(s[2], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    def take(self):
+        """the stages recorded so far as (name, count, seconds, max_rss_kb), cleared for the next take()"""
+        stages = [(k,) + tuple(self.stages[k]) for k in self.order]
+        self.stages,self.order = {},[]
+        return stages
+
+    def merge(self, stages):
+        """add stages recorded in another process (take() of a ProfiledTask), None for nothing"""
+        for name,count,seconds,max_rss_kb in stages or ():
+            if name not in self.stages:
+                self.stages[name] = [0, 0.0, 0]
+                self.order.append(name)
+            s = self.stages[name]
+            s[0] += count
+            s[1] += seconds
+            s[2] = max(s[2], max_rss_kb)
+
+    def stage(self, name):
+        """context manager recording one occurrence of stage name"""
+        return ProfileStage(self, name) if self.enabled else NULL_STAGE
+
+    def report(self):
+        """dict of the run: seconds, max_rss_kb (this process and the largest child) and the stages in first-seen order"""
+        return {
+            'seconds': round(time.time() - self.t0, 6),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children_max_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'stages': [dict(stage=k, count=self.stages[k][0], seconds=round(self.stages[k][1], 6),
+                            max_rss_kb=self.stages[k][2]) for k in self.order],
+        }
+
+    def write(self, filename):
+        """write report() as json if filename ends with .json, otherwise as tab-delimited text"""
+        report = self.report()
+        with open(filename, 'w') as f:
+            if filename.endswith('.json'):
+                json.dump(report, f, indent=2, sort_keys=True)
+                f.write('\n')
+                return
+            f.write('#stage\tcount\tseconds\tmax_rss_kb\n')
+            for s in report['stages']:
+                f.write('%s\t%d\t%.6f\t%d\n' % (s['stage'], s['count'], s['seconds'], s['max_rss_kb']))
+            f.write('total\t1\t%.6f\t%d\n' % (report['seconds'], report['max_rss_kb']))
+            f.write('children\t0\t0\t%d\n' % report['children_max_rss_kb'])
+
+class ProfileStage(object):
+    """one occurrence of a stage, see Profile.stage()"""
+
+    def __init__(self, profile, name):
+        self.profile,self.name = profile,name
+
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add(self.name, self.t0)
+        return False
+
+class NullStage(object):
+    """stage of a disabled Profile, does nothing"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+PROFILE = Profile()  # the run's profile, enabled by --profile
+
+def profiled(name):
+    """decorator recording each call of the function as stage name of PROFILE, a plain call when it is off"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILE.enabled:
+                return func(*args, **kwargs)
+            t0 = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                PROFILE.add(name, t0)
+        return wrapper
+    return decorate
+
+class ProfiledTask(object):
+    """func for a process pool, returning (result, stages) where stages are those PROFILE recorded
+    in the worker during the call, for PROFILE.merge() in the parent (None when it is off)
+
+    The workers are forked with the parent's PROFILE, so what it held before the call is dropped.
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        if not PROFILE.enabled:
+            return self.func(*args), None
+        PROFILE.take()
+        result = self.func(*args)
+        return result, PROFILE.take()
+
+class Progress(object):
+    """Throttled progress of the running task: amount done, rate, ETA (if the total is known) and best score
+
+    A line goes to stderr, and a json line to the log file if there is one, at most once per
+    interval seconds (the first one interval seconds after the task starts), so tasks shorter
+    than the interval are not reported. Nothing is written to stderr when quiet, and update()
+    does not even read the clock when there is nowhere to write.
+
+    A task started while another is running (e.g. the candidates of one split of a partition)
+    is reported in its place until it finishes, then the outer task resumes.
+    """
+
+    def __init__(self):
+        self.interval = 10.0
+        self.quiet = False
+        self.log = None
+        self.task = None
+        self.done = 0
+        self.next = None
+        self.outer = []  # state of the tasks a nested task was started in
+
+    def configure(self, interval=10.0, quiet=False, log=None):
+        """set the interval (seconds) between reports, silence stderr, and/or log json lines to file log"""
+        self.interval,self.quiet = interval,quiet
+        if self.log is not None:
+            self.log.close()
+        self.log = open(log, 'a') if log is not None else None
+        if self.quiet and self.log is None:
+            self.next = None
+
+    def start(self, task, unit, total=None):
+        """begin reporting on task, counted in unit (e.g. sites, trees), total units if known"""
+        if self.task is not None:
+            self.outer.append((self.task, self.unit, self.total, self.done, self.best, self.t0))
+        self.task,self.unit,self.total = task,unit,total
+        self.done = 0
+        self.best = None
+        self.t0 = time.time()
+        if self.quiet and self.log is None:
+            self.next = None
+        elif not self.outer or self.next is None:  #a nested task does not put off the next report
+            self.next = self.t0 + self.interval
+
+    def update(self, n=1, best=None):
+        """n more units done; best is the best score so far, if any"""
+        self.done += n
+        if best is not None:
+            self.best = best
+        if self.next is not None and time.time() >= self.next:
+            self.report('running')
+
+    def finish(self, best=None):
+        """report the task as done (if the interval has passed since the last report)"""
+        if best is not None:
+            self.best = best
+        if self.next is not None and time.time() >= self.next:
+            self.report('done')
+        if self.outer:
+            self.task,self.unit,self.total,self.done,self.best,self.t0 = self.outer.pop()
+        else:
+            self.task = None
+            self.next = None
+
+    def report(self, state):
+        if self.quiet and self.log is None:
+            return
+        now = time.time()
+        self.next = now + self.interval
+        elapsed = now - self.t0
+        rate = self.done/elapsed if elapsed > 0 else 0.0
+        eta = (self.total-self.done)/rate if self.total is not None and rate > 0 else None
+        if not self.quiet:
+            line = '%s %s: %d%s %s, %.1f %s/s, %s elapsed' % (self.task, state, self.done,
+                   '' if self.total is None else '/%d' % self.total, self.unit, rate, self.unit, format_seconds(elapsed))
+            if eta is not None and state != 'done':
+                line += ', ETA %s' % format_seconds(eta)
+            if self.best is not None:
+                line += ', best %.4f' % self.best
+            print(line, file=sys.stderr)
+        if self.log is not None:
+            self.log.write(json.dumps(dict(time=round(now, 3), task=self.task, state=state, unit=self.unit,
+                                           done=self.done, total=self.total, rate=rate, elapsed=elapsed,
+                                           eta=eta, best=None if self.best is None else float(self.best)), sort_keys=True) + '\n')
+            self.log.flush()
+
+PROGRESS = Progress()  # the run's progress reporter, set up by --progress/--progress-log/--quiet
+
+def format_seconds(seconds):
+    """h:mm:ss"""
+    m,s = divmod(int(seconds), 60)
+    h,m = divmod(m, 60)
+    return '%d:%02d:%02d' % (h, m, s)
+
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None  # None: the default temp dir
+SHARED_FILES = {}  # file of each SharedArray -> pid of the process that removes it
+ATTACHED = {}  # file -> (token, array) of the SharedArray mapped by this process
+
+class SharedArray(object):
+    """A numpy array copied once into a memory-mapped temp file (in /dev/shm if possible), for process pools
+
+    Only this descriptor (file name, dtype, shape) is pickled to the workers, which map the file
+    read-only with attach() instead of each receiving a copy of the array. The file is removed by
+    close() (or leaving a with block), or at the latest when the process that created it exits,
+    including on SIGINT (KeyboardInterrupt) and SIGTERM.
+
+    Args:
+        a (np.array): array to share
+    """
+
+    def __init__(self, a):
+        a = np.ascontiguousarray(a)
+        if not SHARED_FILES:
+            catch_sigterm()
+        fd,self.filename = tempfile.mkstemp(prefix='treecall.', suffix='.npy', dir=SHARED_DIR)
+        os.close(fd)
+        SHARED_FILES[self.filename] = os.getpid()
+        self.token = os.urandom(16)  #tells this array from a later one that gets the same file name
+        self.dtype,self.shape = a.dtype.str,a.shape
+        if a.size:  #an empty file cannot be mapped
+            m = np.memmap(self.filename, dtype=a.dtype, mode='w+', shape=a.shape)
+            m[...] = a
+            m.flush()
+            del m
+
+    def array(self):
+        return attach(self)
+
+    def close(self):
+        remove_shared(self.filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+def attach(a):
+    """the array of SharedArray a, mapped read-only once per process; a itself if it is already an array
+
+    Mappings are kept by file name and token. Mapping a new SharedArray drops the mappings of those
+    whose file has been removed since (or reused by this one), so a worker of a long-lived pool holds
+    on to a removed array only until it is given the next one.
+    """
+    if not isinstance(a, SharedArray):
+        return a
+    token,array = ATTACHED.get(a.filename, (None, None))
+    if token != a.token:
+        ATTACHED.pop(a.filename, None)  #an earlier array that had the same file name
+        for filename in [f for f in ATTACHED if not os.path.exists(f)]:
+            del ATTACHED[filename]  #removed by the process that created it
+        if 0 in a.shape:
+            array = np.empty(a.shape, dtype=np.dtype(a.dtype))
+        else:
+            array = np.memmap(a.filename, dtype=np.dtype(a.dtype), mode='r', shape=a.shape)
+        ATTACHED[a.filename] = (a.token, array)
+    return array
+
+def remove_shared(filename):
+    """remove the file of a SharedArray, only in the process that created it (not in forked workers)"""
+    if SHARED_FILES.get(filename) != os.getpid():
+        return
+    del SHARED_FILES[filename]
+    ATTACHED.pop(filename, None)
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+@atexit.register
+def remove_all_shared():
+    for filename in list(SHARED_FILES):
+        remove_shared(filename)
+
+def catch_sigterm():
+    """turn SIGTERM into SystemExit (if it is not handled already), so that the SharedArray files are removed"""
+    def terminate(signum, frame):
+        sys.exit(128+signum)
+    try:
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, terminate)
+    except ValueError:  #not the main thread
+        pass
+
+@profiled('read_vcf')
 def read_vcf(filename, evidence=60):
     """Read vcf file - get info about variants
 
@@ -43,22 +402,14 @@ def read_vcf(filename, evidence=60):
             by common/common, common/less_common, less/less
 
     """
+    vcf = lazy_import('vcf')
     vcffile = vcf.Reader(open(filename, 'r'))
     bases = ['A','C','G','T']
     variants,ADs,PLs = [],[],[]
     
-    #mapping allele to genotype eg row 0, col 2 is ref/alt2 = most common alleles
-    #gives PLs 0,3,5
-    #triallelic the PL pattern is RR,RA1,A1A1,RA2,A1A2,A2A2 
-    #so correctly gets PLs for RR, RA2, A2A2
-    a2g = np.array((
-            ((0,0,0), (0,1,2), (0,3,5), (0,6,9)),
-            ((2,1,0), (2,2,2), (2,4,5), (2,7,9)),
-            ((5,3,0), (5,4,2), (5,5,5), (5,8,9)),
-            ((9,6,0), (9,7,2), (9,8,5), (9,9,9))
-        ))
-    
+    PROGRESS.start('read_vcf', 'sites')
     for v in vcffile:
+        PROGRESS.update()
         if v.REF in bases and v.ALT[0] in bases:  #check snp
             variants.append((v.CHROM,v.POS,v.REF))
             
@@ -66,16 +417,9 @@ def read_vcf(filename, evidence=60):
             ad = np.array([v.genotype(s).data.AD for s in vcffile.samples], dtype=np.uint16) 
             #triallelic the PL pattern is RR,RA1,A1A1,RA2,A1A2,A2A2 
             pl = np.array([v.genotype(s).data.PL for s in vcffile.samples], dtype=np.uint16) #list of PL-as-int in array
-            
-            #ak = columns of two most common alleles ordered by freq
-            #sum ad across samples; order by decreasing depth, take only the two most common alleles
-            ak = ad.sum(axis=0).argsort(kind='mergesort')[-2:][::-1]   
-            #append ad ordered by freq NOT ref,alt
-            ADs.append(ad[...,ak])  
-            
-            #get genotypes' PLs in order of allele freq across samples
-            gk = a2g[ak[0],ak[1]]
-            PLs.append(pl[...,gk])
+            ad,pl = top2_alleles(ad, pl)
+            ADs.append(ad)
+            PLs.append(pl)
     
     variants = np.array(variants)
     ADs = np.array(ADs)
@@ -91,9 +435,38 @@ def read_vcf(filename, evidence=60):
     #variants,ADs,PLs = variants[k_ev],ADs[k_ev],PLs[k_ev]
     #commented about above bc it's probably filtering uncertain variants but that's the whole point of treecall, and we're not sure what it's doing anyway
 
-    print(' done', file=sys.stderr)
+    PROGRESS.finish()
     return vcffile, variants, ADs, PLs
 
+#mapping allele to genotype eg row 0, col 2 is ref/alt2 = most common alleles
+#gives PLs 0,3,5
+#triallelic the PL pattern is RR,RA1,A1A1,RA2,A1A2,A2A2 
+#so correctly gets PLs for RR, RA2, A2A2
+A2G = np.array((
+        ((0,0,0), (0,1,2), (0,3,5), (0,6,9)),
+        ((2,1,0), (2,2,2), (2,4,5), (2,7,9)),
+        ((5,3,0), (5,4,2), (5,5,5), (5,8,9)),
+        ((9,6,0), (9,7,2), (9,8,5), (9,9,9))
+    ))
+
+def top2_alleles(ad, pl):
+    """AD and PL of the two most common alleles of a vcf record, as read_vcf() keeps them
+
+    Args:
+        ad (np.array): AD of each sample for each allele, sample x allele
+        pl (np.array): PL of each sample for each genotype, sample x genotype
+
+    Returns:
+        np.array: AD of the two alleles ordered by freq (NOT ref,alt)
+        np.array: PL of their 3 genotypes, common/common, common/less_common, less/less
+    """
+    #ak = columns of two most common alleles ordered by freq
+    #sum ad across samples; order by decreasing depth, take only the two most common alleles
+    ak = ad.sum(axis=0).argsort(kind='mergesort')[-2:][::-1]   
+    #get genotypes' PLs in order of allele freq across samples
+    gk = A2G[ak[0],ak[1]]
+    return ad[...,ak], pl[...,gk]
+
 def init_tree(tree):
     """
     node.sid = list of children
@@ -235,6 +608,7 @@ def make_base_prior(het, gtypes):
     """
     return normalize_PL(np.array([g[0]!=g[1] for g in gtypes], dtype=np.longdouble)*het)
 
+@profiled('calc_mut_likelihoods')
 def calc_mut_likelihoods(tree, mm0, mm1):
     """
     go through tree from leaves to root - attach PLm to each node (not tips!)
@@ -265,6 +639,54 @@ def calc_mut_likelihoods(tree, mm0, mm1):
 
     return tree
 
+def tree_likelihoods(tree, PLs, mm, mm0, mm1):
+    """
+    populate_tree_PL() with mm and with mm0 plus calc_mut_likelihoods() in one pass from leaves to root,
+    keeping the results off the tree (no copies needed)
+    
+    Args:
+        tree (Tree)
+        PLs (np.array): phred scaled likelihoods
+        mm: mutation matrix (np array of float)
+        mm0: mutation matrix (np array of float) (non-diagonal set to 0)
+        mm1: mutation matrix (np array of float) (diagonal set to 0)
+    
+    Returns:
+        np.array: PL of the root (tree.PL after populate_tree_PL with mm), dim = site x gtype
+        dict: PL0 of each node (node.PL0 after populate_tree_PL with mm0)
+        np.array: PLm of the root (tree.PLm after calc_mut_likelihoods), dim = location x site x gtype
+    """
+    n,m,g = PLs.shape # n sites, m samples, g gtypes
+    PL,PL0,PLm = {},{},{}
+    for node in tree.traverse(strategy='postorder'):
+        if node.is_leaf():
+            PL[node] = PL0[node] = PLs[:,node.sid[0],]
+            continue
+        pl = np.zeros((n,g), dtype=np.longdouble)
+        pl0 = np.zeros((n,g), dtype=np.longdouble)
+        up0 = {} # each child's PL0 carried up without mutation
+        for child in node.children:
+            pl = pl + p2phred(np.dot(phred2p(PL.pop(child)), mm))
+            up0[child] = p2phred(np.dot(phred2p(PL0[child]), mm0))
+            pl0 = pl0 + up0[child]
+        PL[node],PL0[node] = pl,pl0
+
+        plm = np.zeros((2*len(node)-2,n,g), dtype=np.longdouble)  #len(node) = num tips associate
+        i = 0
+        for child in node.children:
+            sister = child.get_sisters()[0]
+            if not child.is_leaf():
+                child_PLm = PLm.pop(child)
+                l = child_PLm.shape[0]
+                plm[i:(i+l)] = p2phred(np.dot(phred2p(child_PLm), mm0)) + up0[sister]
+                i += l
+            plm[i] = p2phred(np.dot(phred2p(PL0[child]), mm1)) + up0[sister]
+            i += 1
+        PLm[node] = plm
+
+    return PL[tree],PL0,PLm[tree]
+
+@profiled('populate_tree_PL')
 def populate_tree_PL(tree, PLs, mm, attr): #e.g. populate_tree_PL(tree, PLs, mm0, 'PL0')
     """
     